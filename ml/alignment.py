@@ -0,0 +1,105 @@
+import numpy as np
+
+from ml import timestamps as ts
+
+
+class ActionTimeline:
+    # Actions of a session as arrays, matched to frame timestamps with
+    # np.searchsorted instead of merging the two streams record by record.
+    # Key and mouse button states are boolean matrices with one column
+    # per name in key_names / button_names.
+
+    def __init__(self, actions):
+        self.times = ts.records_timestamps(actions)
+        self.mouse_positions = np.array([a["mouse_position"] for a in actions],
+                                        dtype=np.int64).reshape(-1, 2)
+
+        self.key_names = sorted({k for a in actions for k in a["keys"]})
+        self.button_names = sorted({b for a in actions for b in a["mouse_buttons"]})
+        self.keys = ActionTimeline._states_matrix([a["keys"] for a in actions], self.key_names)
+        self.mouse_buttons = ActionTimeline._states_matrix(
+            [a["mouse_buttons"] for a in actions], self.button_names)
+
+        self.left_btn_pressed = np.array(["mouse left" in a["mouse_buttons"] for a in actions],
+                                         dtype=bool)
+
+    @classmethod
+    def from_log(cls, key_names, button_names, rows):
+        # timeline of a binary action log, see recording/action_log.read_log
+        timeline = cls.__new__(cls)
+        timeline.times = np.asarray(rows["time_ns"], dtype=np.int64)
+        timeline.mouse_positions = np.stack([rows["x"], rows["y"]], axis=1).astype(np.int64)
+
+        key_bits = ActionTimeline._bits_matrix(rows["keys"])
+        button_bits = ActionTimeline._bits_matrix(rows["buttons"])
+        key_columns = ActionTimeline._used_bits(key_bits, key_names)
+        button_columns = ActionTimeline._used_bits(button_bits, button_names)
+
+        timeline.key_names = [name for name, _ in key_columns]
+        timeline.button_names = [name for name, _ in button_columns]
+        timeline.keys = key_bits[:, [bit for _, bit in key_columns]]
+        timeline.mouse_buttons = button_bits[:, [bit for _, bit in button_columns]]
+        if "mouse left" in button_names:
+            timeline.left_btn_pressed = button_bits[:, button_names.index("mouse left")]
+        else:
+            timeline.left_btn_pressed = np.zeros(len(rows), dtype=bool)
+        return timeline
+
+    @staticmethod
+    def _bits_matrix(masks):
+        # masks -> boolean matrix with a column per bit
+        masks = np.asarray(masks, dtype=np.uint64)
+        bits = np.arange(masks.dtype.itemsize * 8, dtype=np.uint64)
+        return ((masks[:, None] >> bits) & np.uint64(1)).astype(bool)
+
+    @staticmethod
+    def _used_bits(matrix, names):
+        # (name, bit) of the bits set in any row, sorted by name as in the json timeline
+        return sorted((names[bit] if bit < len(names) else str(bit), bit)
+                      for bit in np.flatnonzero(matrix.any(axis=0)))
+
+    @staticmethod
+    def _states_matrix(states, names):
+        column = {name: i for i, name in enumerate(names)}
+        matrix = np.zeros((len(states), len(names)), dtype=bool)
+        for row, pressed in enumerate(states):
+            matrix[row, [column[name] for name in pressed]] = True
+        return matrix
+
+    def __len__(self):
+        return len(self.times)
+
+    def action_positions(self, frame_times, start=0):
+        # Position of the action in effect for each frame: the latest action
+        # strictly earlier than the frame. Matches the sequential merge this
+        # replaced, including its edge cases: frames before the first action get
+        # the first action, frames after the last one get the second to last
+        # action, and the position never moves backwards (start is the position
+        # reached by the previous block of frames).
+        last = max(len(self.times) - 2, 0)
+        positions = np.searchsorted(self.times, frame_times, side="left") - 1
+        positions = np.clip(positions, 0, last)
+        positions[0:1] = np.maximum(positions[0:1], start)
+        return np.maximum.accumulate(positions)
+
+    def align(self, frame_times, start=0):
+        positions = self.action_positions(frame_times, start)
+        return {
+            "action_position": positions,
+            "mouse_position": self.mouse_positions[positions],
+            "left_btn_pressed": self.left_btn_pressed[positions],
+            "mouse_buttons": self.mouse_buttons[positions],
+            "keys": self.keys[positions]
+        }
+
+
+def relative_mouse_positions(mouse_positions, window_data, recorded_size):
+    # absolute screen (x, y) positions -> (row, column) pixels of the recorded frame
+    mouse_positions = np.asarray(mouse_positions).reshape(-1, 2)
+    offset = np.array(window_data["offset"])
+    size = np.array(window_data["size"])
+    recorded_size = np.array(recorded_size)
+
+    xy = (mouse_positions - offset) * recorded_size // size
+    xy = np.clip(xy, 0, recorded_size - 1)
+    return xy[:, ::-1]
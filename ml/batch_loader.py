@@ -0,0 +1,206 @@
+import queue
+import threading
+import time
+import numpy as np
+
+from ml import data_processing as dp
+
+
+class BatchLoader:
+    # Mini-batches of an exported Dataset (see ml.dataset), assembled by
+    # background threads while the previous batches are used.
+    # Each iteration is an epoch. Records are read shard by shard, in a random
+    # shard order when shuffle_buffer > 1, through a buffer of shuffle_buffer
+    # records from which a random one is taken each time; 0 keeps the recorded
+    # order. The order only depends on seed and the epoch number.
+    # Batches are dicts field -> array of batch_size records, copied into
+    # prefetch + 1 preallocated buffers which are reused: a batch is valid
+    # until the next one is requested. workers threads fill up to prefetch
+    # batches ahead; copying from the memory maps releases the GIL.
+    # The time spent waiting for each batch is kept, see stats().
+    # mouse_mask: frames of datasets exported without the mouse mask channels
+    # get them added in place in the batch buffer, see dp.mouse_mask_batch.
+
+    poll_interval = 0.1  # seconds between checks whether the epoch was stopped
+
+    def __init__(self, dataset, batch_size, shuffle_buffer=0, seed=0,
+                 prefetch=2, workers=2, drop_last=True, mouse_mask=False):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.prefetch = prefetch
+        self.workers = workers
+        self.drop_last = drop_last
+        self.epoch = 0
+        self.stall_seconds = []  # per batch of the last epoch
+
+        fields = dataset.sessions[0]["fields"] if dataset.sessions else {}
+        shapes = {field: tuple(info["shape"]) for field, info in fields.items()}
+        self._add_mask = mouse_mask and "frame" in shapes and shapes["frame"][2] == 3
+        if self._add_mask:
+            shapes["frame"] = shapes["frame"][:2] + (5,)
+        self._buffers = [{field: np.empty((batch_size, *shapes[field]), np.dtype(info["dtype"]))
+                          for field, info in fields.items()}
+                         for _ in range(prefetch + 1)]
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.dataset) // self.batch_size
+        return -(-len(self.dataset) // self.batch_size)
+
+    def _sample_order(self, rng):
+        # (shard, position) of every record of the epoch
+        shards = np.arange(self.dataset.shard_count)
+        if self.shuffle_buffer <= 1:
+            for n in shards:
+                for position in range(self.dataset.shard_size(n)):
+                    yield n, position
+            return
+
+        rng.shuffle(shards)
+        pool = []
+        for n in shards:
+            for position in range(self.dataset.shard_size(n)):
+                if len(pool) < self.shuffle_buffer:
+                    pool.append((n, position))
+                    continue
+                i = rng.integers(len(pool))
+                yield pool[i]
+                pool[i] = (n, position)
+        rng.shuffle(pool)
+        yield from pool
+
+    def _batches(self, rng):
+        batch = []
+        for sample in self._sample_order(rng):
+            batch.append(sample)
+            if len(batch) == self.batch_size:
+                yield batch
+                batch = []
+        if batch and not self.drop_last:
+            yield batch
+
+    def _fill(self, buffer, batch):
+        frames = []
+        for row, (n, position) in enumerate(batch):
+            arrays = self.dataset.shard(n)
+            for field, out in buffer.items():
+                if field == "frame" and self._add_mask:
+                    frames.append(arrays[field][position])
+                else:
+                    out[row] = arrays[field][position]
+        if self._add_mask:
+            dp.mouse_mask_batch(frames, buffer["relative_mouse_position"][:len(batch)],
+                                buffer["left_btn_pressed"][:len(batch)], out=buffer["frame"])
+
+    def __iter__(self):
+        rng = np.random.default_rng([self.seed, self.epoch])
+        self.epoch += 1
+        self.stall_seconds = []
+
+        tasks = queue.Queue(maxsize=self.prefetch)
+        free = queue.Queue()
+        for buffer in self._buffers:
+            free.put(buffer)
+        done = {}  # batch number -> (buffer, records)
+        condition = threading.Condition()
+        state = {"batches": None, "error": None}
+        stop = threading.Event()
+
+        def put(q, item):
+            while not stop.is_set():
+                try:
+                    q.put(item, timeout=BatchLoader.poll_interval)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def get(q):
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=BatchLoader.poll_interval)
+                except queue.Empty:
+                    pass
+            return None
+
+        def plan():
+            batches = 0
+            for batches, batch in enumerate(self._batches(rng), 1):
+                if not put(tasks, (batches - 1, batch)):
+                    return
+            with condition:
+                state["batches"] = batches
+                condition.notify_all()
+            for _ in range(self.workers):
+                put(tasks, None)
+
+        def fill():
+            while True:
+                # the buffer is taken before the task, so the lowest pending batch
+                # always has one and later batches cannot use up all buffers
+                buffer = get(free)
+                if buffer is None:
+                    return
+                task = get(tasks)
+                if task is None:
+                    return
+                number, batch = task
+                try:
+                    self._fill(buffer, batch)
+                except Exception as e:
+                    with condition:
+                        state["error"] = e
+                        condition.notify_all()
+                    return
+                with condition:
+                    done[number] = (buffer, len(batch))
+                    condition.notify_all()
+
+        threads = [threading.Thread(target=plan, daemon=True)] + \
+                  [threading.Thread(target=fill, daemon=True) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+
+        held = None
+        number = 0
+        try:
+            while True:
+                if held is not None:
+                    free.put(held)
+                    held = None
+
+                start = time.perf_counter()
+                with condition:
+                    while number not in done and state["error"] is None and \
+                            (state["batches"] is None or number < state["batches"]):
+                        condition.wait()
+                    if state["error"] is not None:
+                        raise state["error"]
+                    if number not in done:
+                        break  # all batches of the epoch were used
+                    held, records = done.pop(number)
+                self.stall_seconds.append(time.perf_counter() - start)
+                number += 1
+
+                if records == self.batch_size:
+                    yield held
+                else:
+                    yield {field: out[:records] for field, out in held.items()}
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+
+    def stats(self):
+        # batches of the last epoch and the time spent waiting for them,
+        # a large stall means that the loader and not the model is the bottleneck
+        if not self.stall_seconds:
+            return {"batches": 0, "stall_s": 0.0, "mean_stall_ms": 0.0, "max_stall_ms": 0.0}
+        return {
+            "batches": len(self.stall_seconds),
+            "stall_s": sum(self.stall_seconds),
+            "mean_stall_ms": 1e3 * sum(self.stall_seconds) / len(self.stall_seconds),
+            "max_stall_ms": 1e3 * max(self.stall_seconds)
+        }
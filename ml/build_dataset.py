@@ -0,0 +1,156 @@
+import argparse
+import json
+import multiprocessing as mp
+import os
+import shutil
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ml import data_processing as dp
+from ml import dataset as ds
+from ml import timestamps as ts
+
+# Builds the training data of every session in a data directory.
+# usage: python build_dataset.py [--data-dir DIR] [--output-dir DIR] [--templates FILE]
+#                                [--workers N] [--force] [--sparse-mask]
+# Sessions are processed by a process pool, largest first, each session by a
+# single worker as soon as it is free, so that a few long sessions do not
+# leave the other workers idle at the end.
+# The output of a session is the directory <output dir>/<postfix> with the
+# records of dp.data_generator_with_changes as .npy shards, see ml.dataset,
+# which is also the loader. It is written under a temporary name and renamed
+# when complete, sessions whose output is newer than all of their input files
+# are skipped. The manifest is rewritten after every build.
+# With --sparse-mask frames are stored without the mouse mask channels, which
+# the loader can add to whole batches, see BatchLoader.
+
+
+def input_filenames(postfix):
+    return [dp.screen_filename(postfix), dp.actions_filename(postfix),
+            dp.window_parameters_filename(postfix)]
+
+
+def input_size(postfix):
+    return sum(os.path.getsize(filename) for filename in input_filenames(postfix))
+
+
+def is_up_to_date(postfix, output_dir, dense_mask=True):
+    summary = os.path.join(output_dir, postfix, ds.session_filename)
+    if not os.path.exists(summary):
+        return False
+    with open(summary) as f:
+        stats = json.load(f)
+    if "shards" not in stats:
+        return False  # chunks of the format before .npy shards
+    if stats.get("dense_mask", True) != dense_mask:
+        return False
+    built = os.path.getmtime(summary)
+    return all(os.path.getmtime(filename) <= built for filename in input_filenames(postfix))
+
+
+def build_session(task):
+    # worker: writes the output of one session, returns its statistics
+    postfix, data_dir, output_dir, templates_filename, dense_mask = task
+    dp.data_dir = data_dir
+    dp.templates_filename = templates_filename
+
+    start = time.perf_counter()
+    stats = {"postfix": postfix, "input_bytes": input_size(postfix), "records": 0,
+             "dense_mask": dense_mask}
+    final_dir = os.path.join(output_dir, postfix)
+    temporary_dir = final_dir + ".tmp"
+    shutil.rmtree(temporary_dir, ignore_errors=True)
+    os.makedirs(temporary_dir)
+    try:
+        writer = ds.ShardWriter(temporary_dir)
+        for record in dp.data_generator_with_changes(postfix, dense_mask=dense_mask):
+            record["time_ns"] = ts.timestamp_ns(record)
+            writer.add(record)
+        writer.close()
+
+        stats["records"] = writer.records
+        stats["shards"] = writer.shard_sizes
+        stats["fields"] = writer.field_info()
+        stats["seconds"] = time.perf_counter() - start
+        with open(os.path.join(temporary_dir, ds.session_filename), "w") as f:
+            json.dump(stats, f)
+
+        shutil.rmtree(final_dir, ignore_errors=True)
+        os.rename(temporary_dir, final_dir)
+    except Exception as e:
+        shutil.rmtree(temporary_dir, ignore_errors=True)
+        stats["error"] = "{}: {}".format(type(e).__name__, e)
+        stats["seconds"] = time.perf_counter() - start
+    return stats
+
+
+def _throughput(records, input_bytes, seconds):
+    seconds = max(seconds, 1e-9)
+    return "{} records, {:.1f} MB in {:.1f} s ({:.1f} records/s, {:.1f} MB/s)".format(
+        records, input_bytes / 1e6, seconds, records / seconds, input_bytes / 1e6 / seconds)
+
+
+def build(output_dir, workers=None, force=False, dense_mask=True):
+    # returns the statistics of the built sessions
+    postfixes = sorted(dp.sessions(), key=input_size, reverse=True)
+    if not force:
+        skipped = [postfix for postfix in postfixes if is_up_to_date(postfix, output_dir, dense_mask)]
+        postfixes = [postfix for postfix in postfixes if postfix not in skipped]
+        for postfix in skipped:
+            print("{}: up to date".format(postfix))
+
+    os.makedirs(output_dir, exist_ok=True)
+    dp.preload_game_classifier()
+    tasks = [(postfix, dp.data_dir, output_dir, dp.templates_filename, dense_mask)
+             for postfix in postfixes]
+
+    results = []
+    start = time.perf_counter()
+    with mp.Pool(workers) as pool:
+        # one session per task, handed to whichever worker is free next
+        for stats in pool.imap_unordered(build_session, tasks, chunksize=1):
+            if "error" in stats:
+                print("{}: failed, {}".format(stats["postfix"], stats["error"]))
+            else:
+                print("{}: {}".format(stats["postfix"], _throughput(
+                    stats["records"], stats["input_bytes"], stats["seconds"])))
+            results.append(stats)
+    duration = time.perf_counter() - start
+    ds.write_manifest(output_dir)
+
+    built = [stats for stats in results if "error" not in stats]
+    print("built {} sessions, {} failed, {} up to date".format(
+        len(built), len(results) - len(built), len(dp.sessions()) - len(tasks)))
+    print("total: {}".format(_throughput(sum(s["records"] for s in built),
+                                          sum(s["input_bytes"] for s in built), duration)))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the training data of all recorded sessions.")
+    parser.add_argument("--data-dir", default=dp.data_dir,
+                        help="directory with the recorded sessions (default: %(default)s)")
+    parser.add_argument("--output-dir", default=None,
+                        help="output directory (default: <data dir>/dataset)")
+    parser.add_argument("--templates", default=dp.templates_filename,
+                        help="in game cross templates (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="worker processes (default: number of cpus)")
+    parser.add_argument("--force", action="store_true",
+                        help="rebuild sessions which are up to date")
+    parser.add_argument("--sparse-mask", action="store_true",
+                        help="store frames without the mouse mask channels")
+    args = parser.parse_args(argv)
+
+    dp.data_dir = args.data_dir
+    dp.templates_filename = args.templates
+    output_dir = args.output_dir or os.path.join(args.data_dir, "dataset")
+    results = build(output_dir, workers=args.workers, force=args.force,
+                    dense_mask=not args.sparse_mask)
+    return 1 if any("error" in stats for stats in results) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
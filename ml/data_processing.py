@@ -1,3 +1,18 @@
+import datetime
+import json
+import os
+import cv2
+import numpy as np
+
+from recording import numpy_json as nj
+from recording import frame_file as ff
+from recording import video_file as vf
+from recording import action_log as al
+from ml.frame_index import FrameIndex
+from ml import timestamps as ts
+from ml.alignment import ActionTimeline, relative_mouse_positions
+from ml.game_state import GameStateClassifier
+
 top_corner = (3, 150)
 size = (6, 6)
 bottom_corner = (top_corner[0] + size[0], top_corner[1] + size[1])
@@ -7,10 +22,40 @@ def get_ingame_cross(image):
     return image[top_corner[0]:bottom_corner[0], top_corner[1]:bottom_corner[1]]
 
 
+# directory with the session files written by recording/main.py
+data_dir = os.path.join(os.pardir, "data")
+
 ranges = [0, 255]
 histSize = [32]
-[cross1, cross2, cross3] = [json.loads(data, object_hook=nj.json_numpy_obj_hook)["frame"]
-                            for data in open("../data/ingame_crosses_at_3_150.txt").readlines()]
+# reference crops of the in-game cross at top_corner, loaded on first use
+templates_filename = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  os.pardir, "data", "ingame_crosses_at_3_150.txt")
+
+# templates filename -> classifier, built once per process
+_game_classifiers = {}
+
+
+def load_templates(filename):
+    with open(filename) as f:
+        return [json.loads(data, object_hook=nj.json_numpy_obj_hook)["frame"] for data in f]
+
+
+def get_game_classifier(filename=None):
+    if filename is None:
+        filename = templates_filename
+    filename = os.path.abspath(filename)
+
+    classifier = _game_classifiers.get(filename)
+    if classifier is None:
+        classifier = GameStateClassifier(load_templates(filename), top_corner, size,
+                                         hist_size=histSize[0], ranges=ranges)
+        _game_classifiers[filename] = classifier
+    return classifier
+
+
+def preload_game_classifier(filename=None):
+    # call before forking worker processes so that they inherit the loaded templates
+    get_game_classifier(filename)
 
 
 def correl(im1, im2, channel=0):  # by default use zero channel = blue in bgr
@@ -25,33 +70,129 @@ def correl_max(im1, images, chammel=0):
 
 
 def is_game(image):
-    return correl_max(get_ingame_cross(image), [cross1, cross2, cross3]) > 0.8
+    return get_game_classifier()(image)
+
+
+def sessions():
+    # postfixes of the sessions in data_dir, every recorded session has its
+    # window parameters file
+    prefix, postfix_end = "window_parameters_", ".txt"
+    postfixes = []
+    for name in sorted(os.listdir(data_dir)):
+        if name.startswith(prefix) and name.endswith(postfix_end):
+            postfix = name[len(prefix):-len(postfix_end)]
+            if os.path.exists(screen_filename(postfix)) and os.path.exists(actions_filename(postfix)):
+                postfixes.append(postfix)
+    return postfixes
+
+
+def window_parameters_filename(postfix):
+    return os.path.join(data_dir, "window_parameters_{}.txt".format(postfix))
+
+
+def actions_filename(postfix):
+    # binary action log if the session was recorded with it, json lines otherwise
+    filename = os.path.join(data_dir, "actions_{}{}".format(postfix, al.extension))
+    if os.path.exists(filename):
+        return filename
+    return os.path.join(data_dir, "actions_{}.txt".format(postfix))
+
+
+def read_action_timeline(postfix):
+    filename = actions_filename(postfix)
+    if filename.endswith(al.extension):
+        return ActionTimeline.from_log(*al.read_log(filename))
+    return ActionTimeline(read_actions_data(postfix))
 
 
 def read_actions_data(postfix):
-    with open("../data/actions_{}.txt".format(postfix)) as f:
+    with open(os.path.join(data_dir, "actions_{}.txt".format(postfix))) as f:
         data = [json.loads(s, object_hook=nj.json_numpy_obj_hook)
                 for s in f.readlines()]
     return data
 
 
 def read_window_data(postfix):
-    with open("../data/window_parameters_{}.txt".format(postfix)) as f:
+    with open(window_parameters_filename(postfix)) as f:
         data = json.load(f, object_hook=nj.json_numpy_obj_hook)
     return data
 
 
-def screen_data_generator(postfix):
-    with open("../data/screen_{}.txt".format(postfix)) as screen_f:
+def _blocks(iterable, block_len):
+    block = []
+    for item in iterable:
+        block.append(item)
+        if len(block) == block_len:
+            yield block
+            block = []
+    if block:
+        yield block
+
+
+def screen_filename(postfix):
+    # binary frames container or video if the session was recorded with it,
+    # json lines otherwise
+    for extension in (ff.extension, vf.extension):
+        filename = os.path.join(data_dir, "screen_{}{}".format(postfix, extension))
+        if os.path.exists(filename):
+            return filename
+    return os.path.join(data_dir, "screen_{}.txt".format(postfix))
+
+
+def screen_index(postfix):
+    # random access to frames by position or timestamp, see FrameIndex
+    filename = screen_filename(postfix)
+    if filename.endswith(vf.extension):
+        raise ValueError("{} is a video, which is read only sequentially".format(filename))
+    return FrameIndex(filename)
+
+
+def video_records_generator(filename):
+    # same records as the other screen formats, read through cv2.VideoCapture
+    for index, time_ns, monotonic_ns, frame in vf.read_frames(filename):
+        yield {
+            "frame": frame,
+            "datetime": ff.ns_to_datetime_str(time_ns),
+            "index": index,
+            "time_ns": time_ns,
+            "monotonic_ns": monotonic_ns
+        }
+    return
+
+
+def screen_records_generator(postfix):
+    filename = screen_filename(postfix)
+    if filename.endswith(ff.extension):
+        yield from ff.frame_generator(filename)
+        return
+    if filename.endswith(vf.extension):
+        yield from video_records_generator(filename)
+        return
+
+    frame = None
+    with open(filename) as screen_f:
         for s in screen_f:
             screen = json.loads(s, object_hook=nj.json_numpy_obj_hook)
-            if is_game(screen["frame"]):
+            # a repeat record always refers to the last record with a frame
+            if "repeat_of" in screen:
+                del screen["repeat_of"]
+                screen["frame"] = frame
+            frame = screen["frame"]
+            yield screen
+    return
+
+
+def screen_data_generator(postfix, block_len=256):
+    for block in _blocks(screen_records_generator(postfix), block_len):
+        crops = np.stack([get_ingame_cross(screen["frame"]) for screen in block])
+        for screen, in_game in zip(block, get_game_classifier().is_game_crops(crops)):
+            if in_game:
                 yield screen
     return
 
 
 def actions_data_generator(postfix):
-    with open("../data/actions_{}.txt".format(postfix)) as actions_f:
+    with open(os.path.join(data_dir, "actions_{}.txt".format(postfix))) as actions_f:
         for s in actions_f:
             yield json.loads(s, object_hook=nj.json_numpy_obj_hook)
     return
@@ -61,59 +202,83 @@ def get_datetime(s):
     return datetime.datetime.strptime(s, "%Y-%m-%d %H:%M:%S.%f")
 
 
-def data_generator(postfix):
+def data_generator(postfix, block_len=256, dense_mask=True):
+    # dense_mask: frames get the two mouse mask channels, otherwise they keep
+    # their 3 channels and the mouse is only in the "relative_mouse_position" and
+    # "left_btn_pressed" fields, see add_mouse_mask and mouse_mask_batch
     window_data = read_window_data(postfix)
 
     # actions data is a relatively small file compared to screen data, so we can read it all for convinience
-    actions_data = read_actions_data(postfix)
-    screen_gen = screen_data_generator(postfix)
-    actions_gen = actions_data_generator(postfix)
-
-    action_next = next(actions_gen)
-    action_current = action_next
-
-    def next_action(screen_data):
-        # if action_next already later than screen data time
-        if get_datetime(action_next["datetime"]) >= get_datetime(screen_data["datetime"]):
-            return action_current
-
-        for action in actions_gen:
-            action_current = action_next
-            action_next = action
-            # stop iterating if next action wont be earlier than screenshot time
-            if not (get_datetime(action_next["datetime"]) < get_datetime(screen_data["datetime"])):
-                return action_current
-
-    for screen_data in screen_gen:
-        if get_datetime(action_next["datetime"]) < get_datetime(screen_data["datetime"]):
-            for action in actions_gen:
-                action_current = action_next
-                action_next = action
-                # stop iterating if next action wont be earlier than screenshot time
-                if not (get_datetime(action_next["datetime"]) < \
-                        get_datetime(screen_data["datetime"])):
-                    break
-
-        recorded_size = screen_data["frame"].shape[1::-1]
-
-        relative_mouse_position = get_relative_mouse_position(action_current["mouse_position"],
-                                                              window_data, recorded_size)
-
-        left_btn_pressed = "mouse left" in action_current["mouse_buttons"]
-        screen_data["relative_mouse_position"] = relative_mouse_position
-        screen_data["left_btn_pressed"] = left_btn_pressed
-
-        mouse_mask = np.zeros((*screen_data["frame"].shape[:2], 2), dtype=np.uint8)
-
-        mouse_mask[relative_mouse_position[0], relative_mouse_position[1], left_btn_pressed] = 255
-        screen_data["frame"] = np.concatenate([screen_data["frame"], mouse_mask], axis=2)
-
-        yield screen_data
+    timeline = read_action_timeline(postfix)
+    action_position = 0
+
+    # frames are matched to actions a block at a time, see ActionTimeline
+    for block in _blocks(screen_data_generator(postfix), block_len):
+        aligned = timeline.align(ts.records_timestamps(block), start=action_position)
+        action_position = aligned["action_position"][-1]
+
+        for i, screen_data in enumerate(block):
+            yield annotate(screen_data, aligned["mouse_position"][i],
+                           aligned["left_btn_pressed"][i], window_data, dense_mask)
     return
 
 
-def data_generator_with_changes(postfix):
-    data_gen = data_generator(postfix)
+def annotate(screen_data, mouse_position, left_btn_pressed, window_data, dense_mask=True):
+    # adds the mouse position and button state of the action in effect, and
+    # with dense_mask two mask channels with the mouse position to the frame
+    recorded_size = screen_data["frame"].shape[1::-1]
+
+    relative_mouse_position = relative_mouse_positions(mouse_position,
+                                                       window_data, recorded_size)[0]
+
+    left_btn_pressed = bool(left_btn_pressed)
+    screen_data["relative_mouse_position"] = relative_mouse_position
+    screen_data["left_btn_pressed"] = left_btn_pressed
+
+    if dense_mask:
+        screen_data["frame"] = add_mouse_mask(screen_data["frame"], relative_mouse_position,
+                                              left_btn_pressed)
+    return screen_data
+
+
+def add_mouse_mask(frame, relative_mouse_position, left_btn_pressed, out=None):
+    # H x W x 3 frame -> H x W x 5 frame, written into out if given; the two
+    # added channels are zero, except both are 255 at the mouse position while
+    # the left button is pressed (the mask was always built this way: indexing
+    # with the bool selected both channels or none)
+    channels = frame.shape[2]
+    if out is None:
+        out = np.empty((*frame.shape[:2], channels + 2), dtype=np.uint8)
+    out[..., :channels] = frame
+    out[..., channels:] = 0
+    if left_btn_pressed:
+        out[relative_mouse_position[0], relative_mouse_position[1], channels:] = 255
+    return out
+
+
+def mouse_mask_batch(frames, relative_mouse_positions, left_btn_pressed, out=None):
+    # add_mouse_mask for N frames (a sequence of H x W x 3 frames or an array)
+    # written into one N x H x W x 5 array, out if given
+    n = len(frames)
+    height, width, channels = frames[0].shape
+    if out is None:
+        out = np.empty((n, height, width, channels + 2), dtype=np.uint8)
+    for i in range(n):
+        out[i, ..., :channels] = frames[i]
+    out[:n, ..., channels:] = 0
+
+    pressed = np.flatnonzero(left_btn_pressed)
+    relative_mouse_positions = np.asarray(relative_mouse_positions).reshape(-1, 2)[pressed]
+    out[pressed, relative_mouse_positions[:, 0], relative_mouse_positions[:, 1], channels:] = 255
+    return out
+
+
+def data_generator_with_changes(postfix, dense_mask=True):
+    return with_changes(data_generator(postfix, dense_mask=dense_mask))
+
+
+def with_changes(data_gen):
+    # pairs each record with the next one, see data_generator_with_changes
     try:
         data_next = next(data_gen)
     except StopIteration:
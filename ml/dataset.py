@@ -0,0 +1,148 @@
+import json
+import os
+import numpy as np
+
+# Exported training data: the records of dp.data_generator_with_changes as
+# fixed size shards of .npy arrays, one file per field, which are opened as
+# memory maps so that training reads them from the page cache without parsing.
+# Layout of the output directory:
+#   manifest.json                  sessions, their shard sizes and the fields
+#   <postfix>/session.json         statistics and shard sizes of a session
+#   <postfix>/<field>_<shard>.npy  shard_len records (the last shard of a session fewer)
+
+shard_len = 1024
+
+# field -> dtype, shapes of the per record values are taken from the first record
+fields = {
+    # H x W x 5: BGR and two mouse mask channels, H x W x 3 for sessions
+    # exported without the mask (see build_dataset --sparse-mask)
+    "frame": np.uint8,
+    "relative_mouse_position": np.int64,
+    "left_btn_pressed": np.bool_,
+    "next_mouse_move": np.int64,
+    "next_left_btn_pressed": np.bool_,
+    "time_ns": np.int64,
+}
+
+manifest_filename = "manifest.json"
+session_filename = "session.json"
+
+
+def shard_filename(directory, field, shard):
+    return os.path.join(directory, "{}_{:05d}.npy".format(field, shard))
+
+
+class ShardWriter:
+    # Writes records into the shards of one session directory, records are
+    # copied into preallocated shard buffers and each full shard is saved.
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.shard_sizes = []
+        self.field_shapes = None
+        self._buffers = None
+        self._filled = 0
+
+    def add(self, record):
+        if self._buffers is None:
+            self.field_shapes = {field: np.shape(record[field]) for field in fields}
+            self._buffers = {field: np.empty((shard_len, *self.field_shapes[field]), dtype)
+                             for field, dtype in fields.items()}
+        for field, buffer in self._buffers.items():
+            buffer[self._filled] = record[field]
+        self._filled += 1
+        if self._filled == shard_len:
+            self._save_shard()
+
+    def _save_shard(self):
+        shard = len(self.shard_sizes)
+        for field, buffer in self._buffers.items():
+            np.save(shard_filename(self.directory, field, shard), buffer[:self._filled])
+        self.shard_sizes.append(self._filled)
+        self._filled = 0
+
+    def close(self):
+        if self._filled:
+            self._save_shard()
+
+    def field_info(self):
+        # dtype and per record shape of every field, for the manifest
+        shapes = self.field_shapes or {field: () for field in fields}
+        return {field: {"dtype": np.dtype(dtype).str, "shape": list(shapes[field])}
+                for field, dtype in fields.items()}
+
+    @property
+    def records(self):
+        return sum(self.shard_sizes) + self._filled
+
+
+def write_manifest(output_dir):
+    # manifest of all complete sessions in output_dir
+    sessions = []
+    for postfix in sorted(os.listdir(output_dir)):
+        summary = os.path.join(output_dir, postfix, session_filename)
+        if os.path.exists(summary):
+            with open(summary) as f:
+                stats = json.load(f)
+            if "shards" not in stats:
+                continue  # older output, rebuilt by the next build
+            sessions.append({"postfix": postfix, "records": stats["records"],
+                             "shards": stats["shards"], "fields": stats["fields"]})
+
+    temporary = os.path.join(output_dir, manifest_filename + ".tmp")
+    with open(temporary, "w") as f:
+        json.dump({"shard_len": shard_len, "sessions": sessions}, f, indent=1)
+    os.replace(temporary, os.path.join(output_dir, manifest_filename))
+
+
+class Dataset:
+    # Read only access to an exported dataset. Shards are opened with
+    # np.load(mmap_mode="r") when first used.
+    # dataset[i] is the i-th record over all sessions in manifest order,
+    # dataset.shards() gives the field arrays shard by shard.
+
+    def __init__(self, directory, sessions=None):
+        # sessions: postfixes to use, all sessions of the manifest by default
+        self.directory = directory
+        with open(os.path.join(directory, manifest_filename)) as f:
+            manifest = json.load(f)
+
+        self.sessions = [s for s in manifest["sessions"]
+                         if sessions is None or s["postfix"] in sessions]
+        # (postfix, shard number, records) of every shard
+        self._shards = [(s["postfix"], shard, records)
+                        for s in self.sessions for shard, records in enumerate(s["shards"])]
+        self._starts = np.cumsum([0] + [records for _, _, records in self._shards])
+        self._opened = {}
+
+    def __len__(self):
+        return int(self._starts[-1])
+
+    @property
+    def shard_count(self):
+        return len(self._shards)
+
+    def shard_size(self, n):
+        return self._shards[n][2]
+
+    def shard(self, n):
+        # field -> read only memory mapped array of shard n
+        arrays = self._opened.get(n)
+        if arrays is None:
+            postfix, shard, _ = self._shards[n]
+            directory = os.path.join(self.directory, postfix)
+            arrays = {field: np.load(shard_filename(directory, field, shard), mmap_mode="r")
+                      for field in fields}
+            self._opened[n] = arrays
+        return arrays
+
+    def shards(self):
+        for n in range(len(self._shards)):
+            yield self.shard(n)
+
+    def __getitem__(self, i):
+        i = range(len(self))[i]
+        n = int(np.searchsorted(self._starts, i, side="right")) - 1
+        arrays = self.shard(n)
+        position = i - self._starts[n]
+        return {field: array[position] for field, array in arrays.items()}
@@ -0,0 +1,217 @@
+import json
+import mmap
+import os
+import re
+import numpy as np
+
+from recording import numpy_json as nj
+from recording import frame_file as ff
+from ml import timestamps as ts
+
+
+class FrameIndex:
+    # Random access to a screen recording (json lines or binary frames file).
+    # Byte offsets and timestamps of all records are stored in a sidecar
+    # index file, built with a single pass over the recording and rebuilt
+    # only when the recording is newer than the index.
+    # Frames are read from a memory map of the recording. Frames of compressed
+    # recordings are decoded starting from the key frame before them.
+
+    index_dtype = np.dtype([("offset", "<i8"), ("length", "<i8"),
+                            ("time_ns", "<i8"), ("index", "<i8"), ("kind", "u1")])
+    index_postfix = ".idx.npy"
+
+    _time_ns_re = re.compile(rb'"time_ns": (\d+)')
+    _datetime_re = re.compile(rb'"datetime": "([^"]*)"')
+    _index_re = re.compile(rb'"index": (\d+)')
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._index_filename = filename + FrameIndex.index_postfix
+        self._binary = filename.endswith(ff.extension)
+
+        self._file = open(filename, "rb")
+        if os.fstat(self._file.fileno()).st_size > 0:
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._mmap = b""
+
+        if self._binary and len(self._mmap) > 0:
+            self._file.seek(0)
+            self._dtype, self._shape, self._compression = ff.read_header(self._file)
+            self._first_record_offset = self._file.tell()
+
+        self._entries = self._load_or_build_index()
+        self._key_positions = np.flatnonzero(self._entries["kind"] == ff.KIND_KEY)
+        # last decoded frame of a compressed recording, (position, frame)
+        self._decoded = (None, None)
+
+    @property
+    def timestamps(self):
+        return self._entries["time_ns"]
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getitem__(self, n):
+        n = range(len(self._entries))[n]
+        entry = self._entries[n]
+        offset, length = int(entry["offset"]), int(entry["length"])
+
+        if not self._binary:
+            line = self._mmap[offset:offset + length]
+            record = json.loads(line, object_hook=nj.json_numpy_obj_hook)
+            if "repeat_of" in record:
+                record["frame"] = self[self.position(record.pop("repeat_of"))]["frame"]
+            return record
+
+        index, time_ns, monotonic_ns, kind, payload_len = \
+            ff.record_struct.unpack_from(self._mmap, offset)
+        return {
+            "frame": self._frame(n),
+            "datetime": ff.ns_to_datetime_str(time_ns),
+            "index": index,
+            "time_ns": time_ns,
+            "monotonic_ns": monotonic_ns
+        }
+
+    def _payload(self, position):
+        offset = int(self._entries["offset"][position]) + ff.record_struct.size
+        return offset, int(self._entries["length"][position]) - ff.record_struct.size
+
+    def _frame(self, position):
+        kind = self._entries["kind"][position]
+        offset, length = self._payload(position)
+
+        if kind == ff.KIND_REPEAT:
+            repeat_of, = ff.repeat_struct.unpack_from(self._mmap, offset)
+            return self._frame(self.position(repeat_of))
+        if kind == ff.KIND_RAW:
+            return np.frombuffer(self._mmap, self._dtype, count=int(np.prod(self._shape)),
+                                 offset=offset).reshape(self._shape)
+
+        # decode forward from the key frame before position, or from the last
+        # decoded frame when it is closer
+        start = self._key_positions[np.searchsorted(self._key_positions, position, side="right") - 1]
+        decoded_position, frame = self._decoded
+        if decoded_position is not None and start <= decoded_position <= position:
+            start = decoded_position + 1
+        else:
+            frame = None
+
+        for p in range(start, position + 1):
+            kind = self._entries["kind"][p]
+            if kind == ff.KIND_REPEAT:
+                continue
+            offset, length = self._payload(p)
+            frame = ff.decode_frame(kind, self._mmap[offset:offset + length],
+                                    self._dtype, self._shape, self._compression, frame)
+        self._decoded = (position, frame)
+        return frame
+
+    def position(self, index):
+        # position of the record with the given "index" field
+        position = int(np.searchsorted(self._entries["index"], index))
+        if position == len(self._entries) or self._entries["index"][position] != index:
+            raise KeyError(index)
+        return position
+
+    def position_nearest(self, time_ns):
+        # position of the frame with the timestamp closest to time_ns
+        times = self.timestamps
+        if len(times) == 0:
+            raise IndexError("{} has no frames".format(self._filename))
+
+        i = int(np.searchsorted(times, time_ns))
+        if i == 0:
+            return 0
+        if i == len(times):
+            return len(times) - 1
+        return i if times[i] - time_ns < time_ns - times[i - 1] else i - 1
+
+    def nearest(self, time_ns):
+        return self[self.position_nearest(time_ns)]
+
+    def _load_or_build_index(self):
+        if os.path.exists(self._index_filename) and \
+                os.path.getmtime(self._index_filename) >= os.path.getmtime(self._filename):
+            entries = np.load(self._index_filename)
+            if entries.dtype == FrameIndex.index_dtype:
+                return entries
+
+        if self._binary:
+            entries = self._build_binary_index()
+        else:
+            entries = self._build_lines_index()
+
+        try:
+            np.save(self._index_filename, entries)
+        except OSError:
+            pass  # read only location, the index is rebuilt next time
+        return entries
+
+    def _build_binary_index(self):
+        rows = []
+        if len(self._mmap) == 0:
+            return np.array(rows, dtype=FrameIndex.index_dtype)
+
+        offset = self._first_record_offset
+        end = len(self._mmap)
+        while offset + ff.record_struct.size <= end:
+            index, time_ns, _, kind, payload_len = ff.record_struct.unpack_from(self._mmap, offset)
+            length = ff.record_struct.size + payload_len
+            if offset + length > end:
+                break  # truncated last record
+            rows.append((offset, length, time_ns, index, kind))
+            offset += length
+
+        return np.array(rows, dtype=FrameIndex.index_dtype)
+
+    def _build_lines_index(self):
+        offsets, lengths, times, indices = [], [], [], []
+        # lines of older recordings without "time_ns", parsed in bulk at the end
+        legacy_positions, legacy_datetimes = [], []
+        offset = 0
+        end = len(self._mmap)
+        while offset < end:
+            line_end = self._mmap.find(b"\n", offset)
+            if line_end == -1:
+                break  # unfinished last line
+            # only the small fields are parsed, frame data is skipped
+            time_match = FrameIndex._time_ns_re.search(self._mmap, offset, line_end)
+            if time_match is not None:
+                times.append(int(time_match.group(1)))
+            else:
+                time_match = FrameIndex._datetime_re.search(self._mmap, offset, line_end)
+                legacy_positions.append(len(times))
+                legacy_datetimes.append(time_match.group(1).decode())
+                times.append(0)
+            index_match = FrameIndex._index_re.search(self._mmap, offset, line_end)
+
+            offsets.append(offset)
+            lengths.append(line_end - offset)
+            indices.append(int(index_match.group(1)))
+            offset = line_end + 1
+
+        entries = np.zeros(len(offsets), dtype=FrameIndex.index_dtype)
+        entries["offset"] = offsets
+        entries["length"] = lengths
+        entries["time_ns"] = times
+        entries["time_ns"][legacy_positions] = ts.parse_datetimes(legacy_datetimes)
+        entries["index"] = indices
+        return entries
+
+    def close(self):
+        if isinstance(self._mmap, mmap.mmap):
+            try:
+                self._mmap.close()
+            except BufferError:
+                pass  # frames returned by __getitem__ still reference the map
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
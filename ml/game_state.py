@@ -0,0 +1,71 @@
+import numpy as np
+
+
+class GameStateClassifier:
+    # Decides whether frames show the game by comparing the histogram of one
+    # channel of a small crop with the histograms of reference crops.
+    # Same result as cv2.calcHist + cv2.compareHist(HISTCMP_CORREL) per frame,
+    # but reference histograms are computed once and a whole batch of frames
+    # is classified with a few numpy operations.
+
+    def __init__(self, templates, top_corner, size, hist_size=32, ranges=(0, 255),
+                 channel=0, threshold=0.8):
+        self.top_corner = tuple(top_corner)
+        self.size = tuple(size)
+        self.hist_size = hist_size
+        self.channel = channel
+        self.threshold = threshold
+
+        # uint8 value -> bin lookup table, computed as cv2.calcHist does for
+        # uniform ranges, values out of range are marked with -1
+        scale = hist_size / (ranges[1] - ranges[0])
+        bins = np.floor(np.arange(256) * scale - ranges[0] * scale).astype(np.int64)
+        bins[(bins < 0) | (bins >= hist_size)] = -1
+        self._bins = bins
+
+        self._template_hists = self.histograms(np.stack([np.asarray(t) for t in templates]))
+
+    def crop(self, frames):
+        # frames: N x H x W x C, returns a view
+        r0, c0 = self.top_corner
+        return frames[:, r0:r0 + self.size[0], c0:c0 + self.size[1]]
+
+    def histograms(self, crops):
+        # crops: N x h x w x C -> N x hist_size histograms of self.channel
+        n = len(crops)
+        bins = self._bins[crops[..., self.channel].reshape(n, -1)]
+        rows = np.broadcast_to(np.arange(n)[:, None] * self.hist_size, bins.shape)
+        valid = bins >= 0
+        counts = np.bincount((bins + rows)[valid], minlength=n * self.hist_size)
+        return counts.reshape(n, self.hist_size).astype(np.float64)
+
+    def correlations(self, crops):
+        # N x len(templates) absolute correlations of histograms
+        return np.abs(GameStateClassifier._correl(self.histograms(crops), self._template_hists))
+
+    @staticmethod
+    def _correl(h1, h2):
+        # pairwise cv2.HISTCMP_CORREL between rows of h1 and rows of h2
+        total = h1.shape[1]
+        s1, s2 = h1.sum(axis=1), h2.sum(axis=1)
+        num = h1 @ h2.T - np.outer(s1, s2) / total
+        var1 = (h1 * h1).sum(axis=1) - s1 * s1 / total
+        var2 = (h2 * h2).sum(axis=1) - s2 * s2 / total
+        denom = np.outer(var1, var2)
+
+        result = np.ones_like(num)
+        defined = np.abs(denom) > np.finfo(np.float64).eps
+        result[defined] = num[defined] / np.sqrt(denom[defined])
+        return result
+
+    def is_game_crops(self, crops):
+        # boolean mask for a batch of already cropped frames
+        if len(crops) == 0:
+            return np.zeros(0, dtype=bool)
+        return self.correlations(crops).max(axis=1) > self.threshold
+
+    def is_game_batch(self, frames):
+        return self.is_game_crops(self.crop(frames))
+
+    def __call__(self, frame):
+        return bool(self.is_game_batch(frame[np.newaxis])[0])
@@ -0,0 +1,107 @@
+import collections
+import multiprocessing as mp
+import os
+import numpy as np
+
+from ml import data_processing as dp
+from ml import timestamps as ts
+from recording import video_file as vf
+
+# Preprocessing of one session on several cores.
+# The screen recording is split into shards of consecutive records, using the
+# byte offsets of FrameIndex (so shards of json files start on line
+# boundaries). Worker processes decode, filter and annotate whole shards, and
+# the results are yielded in recording order, the same records as
+# dp.data_generator yields.
+# Actions are matched to the frames of a shard without knowing the action
+# position reached by the previous shards; the position never moves backwards
+# in the sequential path, so records of a shard matched to an earlier action
+# than the previous shards reached are annotated again in the parent.
+
+shard_len = 512  # records per shard
+
+
+# state of a worker process, set by _init_worker
+_worker = {}
+
+
+def _init_worker(postfix, data_dir, templates_filename, dense_mask):
+    _worker["dense_mask"] = dense_mask
+    dp.data_dir = data_dir
+    dp.templates_filename = templates_filename
+    _worker["index"] = dp.screen_index(postfix)
+    _worker["timeline"] = dp.read_action_timeline(postfix)
+    _worker["window_data"] = dp.read_window_data(postfix)
+
+
+def _process_shard(shard):
+    # in game records of the shard, annotated, and their action positions
+    index, timeline = _worker["index"], _worker["timeline"]
+    start, stop = shard
+
+    block = [index[i] for i in range(start, stop)]
+    crops = np.stack([dp.get_ingame_cross(screen["frame"]) for screen in block])
+    block = [screen for screen, in_game in
+             zip(block, dp.get_game_classifier().is_game_crops(crops)) if in_game]
+    if not block:
+        return [], np.zeros(0, dtype=np.int64)
+
+    aligned = timeline.align(ts.records_timestamps(block))
+    records = [dp.annotate(screen_data, aligned["mouse_position"][i],
+                           aligned["left_btn_pressed"][i], _worker["window_data"],
+                           _worker["dense_mask"])
+               for i, screen_data in enumerate(block)]
+    return records, aligned["action_position"]
+
+
+def parallel_data_generator(postfix, workers=None, dense_mask=True):
+    # same records as dp.data_generator(postfix, dense_mask=dense_mask),
+    # computed by worker processes
+    filename = dp.screen_filename(postfix)
+    if filename.endswith(vf.extension):
+        # videos are read only sequentially
+        yield from dp.data_generator(postfix, dense_mask=dense_mask)
+        return
+
+    with dp.screen_index(postfix) as index:
+        n = len(index)
+    shards = [(start, min(start + shard_len, n)) for start in range(0, n, shard_len)]
+    if workers is None:
+        workers = os.cpu_count()
+
+    window_data = dp.read_window_data(postfix)
+    timeline = dp.read_action_timeline(postfix)
+    dp.preload_game_classifier()
+
+    with mp.Pool(workers, initializer=_init_worker,
+                 initargs=(postfix, dp.data_dir, dp.templates_filename, dense_mask)) as pool:
+        # at most two shards per worker are in flight, so that the results
+        # do not pile up in memory when the consumer is slower than the workers
+        pending = collections.deque()
+        shards = iter(shards)
+        action_position = 0
+        while True:
+            while len(pending) < 2 * workers:
+                shard = next(shards, None)
+                if shard is None:
+                    break
+                pending.append(pool.apply_async(_process_shard, (shard,)))
+            if not pending:
+                break
+
+            records, positions = pending.popleft().get()
+            for i in np.flatnonzero(positions < action_position):
+                screen_data = records[i]
+                screen_data["frame"] = screen_data["frame"][..., :3]
+                dp.annotate(screen_data, timeline.mouse_positions[action_position],
+                            timeline.left_btn_pressed[action_position], window_data, dense_mask)
+            if len(positions):
+                action_position = max(action_position, positions[-1])
+            yield from records
+    return
+
+
+def parallel_data_generator_with_changes(postfix, workers=None, dense_mask=True):
+    # same records as dp.data_generator_with_changes(postfix), the next_* fields
+    # of the last record of a shard come from the first record of the next one
+    return dp.with_changes(parallel_data_generator(postfix, workers, dense_mask))
@@ -0,0 +1,40 @@
+import datetime
+import numpy as np
+
+# Recordings carry "time_ns" (wall clock, ns since epoch, taken when the data
+# was captured). Older recordings only have the "datetime" local time string
+# written by JsonWriter, these are converted to the same ns since epoch.
+
+_us_per_hour = 3600 * 10 ** 6
+
+
+def _utc_offset_us(local_hour):
+    # local time - utc in microseconds for an hour since 1970-01-01 in local time
+    local = datetime.datetime(1970, 1, 1) + datetime.timedelta(hours=int(local_hour))
+    return local_hour * _us_per_hour - int(local.timestamp()) * 10 ** 6
+
+
+def parse_datetimes(strings):
+    # local time strings as written by JsonWriter -> int64 array of ns since epoch
+    local_us = np.array(strings, dtype="datetime64[us]").astype(np.int64)
+    if len(local_us) == 0:
+        return local_us
+
+    # utc offset only changes on daylight saving transitions,
+    # so it is computed once per distinct hour rather than per string
+    hours, inverse = np.unique(local_us // _us_per_hour, return_inverse=True)
+    offsets = np.array([_utc_offset_us(h) for h in hours], dtype=np.int64)
+    return (local_us - offsets[inverse.reshape(-1)]) * 1000
+
+
+def timestamp_ns(record):
+    if "time_ns" in record:
+        return record["time_ns"]
+    return int(parse_datetimes([record["datetime"]])[0])
+
+
+def records_timestamps(records):
+    # int64 array of ns since epoch for a list of records
+    if all("time_ns" in r for r in records):
+        return np.array([r["time_ns"] for r in records], dtype=np.int64)
+    return parse_datetimes([r["datetime"] for r in records])
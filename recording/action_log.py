@@ -0,0 +1,71 @@
+import os
+import struct
+import numpy as np
+
+# Binary action log, one fixed width row per input state.
+# File layout: header, then rows
+#   header: magic, format version, key bit names, button bit names
+#           (names are "\n" separated, see input_bits), padded to header_size
+#           bytes so that it can be rewritten in place when keys get new bits
+#           during a recording (version 1 headers are not padded)
+#   row: wall clock timestamp (ns since epoch), monotonic clock timestamp (ns),
+#        mouse x, mouse y, pressed keys mask, pressed mouse buttons mask
+# Bit i of a mask is set when the key or button with name i is pressed.
+# The rows are read at once as a numpy structured array.
+
+extension = ".actions"
+
+MAGIC = b"TAACTION"
+VERSION = 2
+header_size = 4096
+
+_header_struct = struct.Struct("<8sBII")  # magic, version, len(key names), len(button names)
+row_struct = struct.Struct("<qqiiQI")
+row_dtype = np.dtype([("time_ns", "<i8"), ("monotonic_ns", "<i8"),
+                      ("x", "<i4"), ("y", "<i4"),
+                      ("keys", "<u8"), ("buttons", "<u4")])
+
+
+def pack_header(key_names, button_names):
+    keys = "\n".join(key_names).encode()
+    buttons = "\n".join(button_names).encode()
+    header = _header_struct.pack(MAGIC, VERSION, len(keys), len(buttons)) + keys + buttons
+    if len(header) > header_size:
+        raise ValueError("action log header of {} bytes is too long".format(len(header)))
+    return header.ljust(header_size, b"\0")
+
+
+def read_header(f):
+    # returns key names, button names; leaves file positioned at the first row
+    magic, version, keys_len, buttons_len = _header_struct.unpack(f.read(_header_struct.size))
+    if magic != MAGIC:
+        raise ValueError("{} is not an action log".format(getattr(f, "name", f)))
+    if version not in (1, VERSION):
+        raise ValueError("unsupported action log version {}".format(version))
+
+    key_names = tuple(f.read(keys_len).decode().split("\n"))
+    button_names = tuple(f.read(buttons_len).decode().split("\n"))
+    if version == VERSION:
+        f.seek(header_size)
+    return key_names, button_names
+
+
+def pack_row(time_ns, monotonic_ns, x, y, keys, buttons):
+    return row_struct.pack(time_ns, monotonic_ns, x, y, keys, buttons)
+
+
+def read_log(filename):
+    # returns key names, button names and the rows as a read only structured
+    # array mapped from the file; a row cut by an interrupted recording is ignored
+    if os.path.getsize(filename) == 0:
+        return (), (), np.zeros(0, dtype=row_dtype)  # header is written with the first row
+    with open(filename, "rb") as f:
+        key_names, button_names = read_header(f)
+        offset = f.tell()
+        f.seek(0, 2)
+        rows = (f.tell() - offset) // row_dtype.itemsize
+
+    if rows == 0:
+        return key_names, button_names, np.zeros(0, dtype=row_dtype)
+    data = np.memmap(filename, dtype=row_dtype, mode="r", offset=offset, shape=(rows,))
+    return key_names, button_names, data
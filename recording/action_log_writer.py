@@ -0,0 +1,35 @@
+import json_writer as jw
+import action_log as al
+import input_bits as ib
+
+
+class ActionLogWriter(jw.JsonWriter):
+    # writes ActionWatcher records into the binary action log instead of json
+    # lines (see action_log for the layout); key and button names of the
+    # records are stored as bits, see input_bits. The header is rewritten when
+    # keys got new bits since it was written.
+
+    def __init__(self, filename):
+        super().__init__(filename)
+        self._header_keys = 0  # key names in the written header
+
+    def _serialize(self, d):
+        x, y = d["mouse_position"]
+        return al.pack_row(d["time_ns"], d["monotonic_ns"], x, y,
+                           ib.key_mask(d["keys"]), ib.button_mask(d["mouse_buttons"]))
+
+    def _serialize_batch(self, data):
+        rows = super()._serialize_batch(data)
+        # names are taken after the rows, so they include every bit the rows use
+        key_names = tuple(ib.key_names)
+        if len(key_names) == self._header_keys:
+            return rows
+        header = al.pack_header(key_names, ib.button_names)
+        first = self._header_keys == 0
+        self._header_keys = len(key_names)
+        if first:
+            return header + rows
+        self._file.seek(0)
+        self._file.write(header)
+        self._file.seek(0, 2)
+        return rows
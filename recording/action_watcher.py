@@ -1,27 +1,78 @@
 import pyxhook
-import threading
+import collections
 import datetime
 import time
-import numpy as np
+
+import input_bits as ib
+from async_stream import StreamHub
+import raw_input_log as ril
+
+
+class InputState(collections.namedtuple(
+        "InputState", ["time_ns", "monotonic_ns", "mouse_position", "keys", "mouse_buttons"])):
+    # immutable input state snapshot passed to ActionWatcher callbacks,
+    # keys and mouse_buttons are masks of the pressed keys and buttons, see input_bits
+    __slots__ = ()
+
+    @property
+    def key_names(self):
+        return ib.mask_names(self.keys, ib.key_names)
+
+    @property
+    def button_names(self):
+        return ib.mask_names(self.mouse_buttons, ib.button_names)
+
+    def as_record(self):
+        # dict written by JsonWriter, with the names of pressed keys and buttons
+        return {
+            "mouse_position": list(self.mouse_position),
+            "keys": self.key_names,
+            "mouse_buttons": self.button_names,
+            "time_ns": self.time_ns,
+            "monotonic_ns": self.monotonic_ns
+        }
 
 
 class ActionWatcher:
     # when to call callback for a mouse move event
     noticeable_mouse_move_length = 16
 
-    def __init__(self, on_event=None):
+    def __init__(self, on_event=None, queue_size=None, overflow="block",
+                 on_raw_event=None, motion_window_ms=0):
+        # with queue_size set, events are handled and on_event is called on a
+        # dispatcher thread fed through a bounded queue instead of the X record
+        # thread, overflow is one of EventQueue.overflow_policies
+        # on_event gets an InputState
+        # raw mode: with on_raw_event set, it gets a RawInputEvent (see
+        # raw_input_log) for every key, button and motion event, with the X server
+        # and host receive timestamps; motion events less than motion_window_ms
+        # after the last passed one are coalesced into the latest of them,
+        # which is passed on before the next key or button event, 0 passes all
         if on_event is None:
             on_event = lambda data: None
 
         self._on_event = on_event
-
-        self._pressed_keys = set()
-        self._mouse_position = [0, 0]
-        self._old_reported_position = self._mouse_position
-
-        self._pressed_mouse_buttons = set()
+        self._on_raw_event = on_raw_event
+        self._streams = StreamHub()
+        self._motion_window_ms = motion_window_ms
+        self._last_motion_time = None
+        self._pending_motion = None
+
+        # (mouse position, pressed keys mask, pressed buttons mask), replaced
+        # as a whole so that query() needs no lock
+        self._state = ((0, 0), 0, 0)
+        self._old_reported_position = (0, 0)
+
+        # key or button name reported by pyxhook -> bit, None for keys which
+        # are not tracked; filled on the first event of each key
+        self._key_bits = {}
+        self._button_bits = {}
+        # substrings of the tracked control key names
+        self.interesting_keys = list(ib.interesting_keys)
 
         self._hook_thread = pyxhook.HookManager()
+        if queue_size is not None:
+            self._hook_thread.enable_dispatch_thread(queue_size, overflow)
 
         self._hook_thread.KeyDown = self._on_key_event
         self._hook_thread.KeyUp = self._on_key_event
@@ -29,73 +80,140 @@ class ActionWatcher:
         self._hook_thread.MouseAllButtonsUp = self._on_mouse_button_event
         self._hook_thread.MouseMovement = self._on_mouse_move_event
 
-        self._query_lock = threading.Lock()
+    @property
+    def interesting_keys(self):
+        return self._interesting_keys
 
-        self.interesting_keys = ["esc", "space", "alt", "tab",
-                                    "shift", "control",
-                                    "caps", "left", "right", "up", "down"]
+    @interesting_keys.setter
+    def interesting_keys(self, keys):
+        # which keys are tracked is decided again for every key
+        self._interesting_keys = keys
+        self._key_bits = {}
 
-    def query(self):
-        with self._query_lock:
-            data = {
-                "mouse_position": self._mouse_position,
-                "keys": list(self._pressed_keys),
-                "mouse_buttons": list(self._pressed_mouse_buttons)
-            }
-        return data
-
-    def _on_key_event(self, event):
+    def _tracked_key_bit(self, key):
         #  Track letters ignoring case, control key names(ex "shift") and digits
-        key = event.key.casefold()
+        key = key.casefold()
         if not (key.isalpha() or key == " " or len(key) > 1):
-            return
+            return None
+        if len(key) > 1 and not any(ctrl in key for ctrl in self.interesting_keys):
+            return None
+        return ib.key_bit(key)
 
-        if len(key) > 1 and len([True for ctrl in self.interesting_keys if ctrl in key]) == 0:
+    def query(self):
+        mouse_position, keys, mouse_buttons = self._state
+        return InputState(time.time_ns(), time.monotonic_ns(), mouse_position, keys, mouse_buttons)
+
+    def queue_stats(self):
+        # pending, dropped and coalesced events counters of the dispatch queue
+        if self._hook_thread.event_queue is None:
+            return None
+        return self._hook_thread.event_queue.stats()
+
+    def events(self, maxsize=256, policy="all"):
+        # async iterator over the InputState snapshots passed to on_event,
+        # "async for state in watcher.events()", see AsyncStream for the policies;
+        # ends when the watcher is stopped
+        return self._streams.subscribe(maxsize, policy)
+
+    def _report(self, event):
+        # state snapshot stamped with the time the event which changed it was
+        # received from the X server, not when it is handled, which can be
+        # later with the dispatch queue; the wall clock time is that of the
+        # same instant
+        monotonic_ns = event.received_ns or time.monotonic_ns()
+        time_ns = monotonic_ns + time.time_ns() - time.monotonic_ns()
+        state = InputState(time_ns, monotonic_ns, *self._state)
+        self._on_event(state)
+        self._streams.put(state)
+
+    def _report_raw(self, event_type, event, key_bit=ril.NO_BIT):
+        self._flush_motion()
+        x, y = self._state[0]
+        self._on_raw_event(ril.RawInputEvent(event.received_ns, event.time, event_type,
+                                             event.detail, key_bit, x, y))
+
+    def _report_raw_motion(self, event):
+        x, y = event.position
+        raw_event = ril.RawInputEvent(event.received_ns, event.time, ril.MOTION, 0, ril.NO_BIT, x, y)
+        # server time is 32 bit milliseconds which wrap around
+        if self._motion_window_ms > 0 and self._last_motion_time is not None and \
+                (event.time - self._last_motion_time) & 0xffffffff < self._motion_window_ms:
+            self._pending_motion = raw_event
             return
+        self._pending_motion = None
+        self._last_motion_time = event.time
+        self._on_raw_event(raw_event)
+
+    def _flush_motion(self):
+        # passes on the coalesced motion event which is still held back
+        if self._pending_motion is not None:
+            self._last_motion_time = self._pending_motion.server_time
+            self._on_raw_event(self._pending_motion)
+            self._pending_motion = None
 
-        old_pressed_keys_len = len(self._pressed_keys)
+    def _on_key_event(self, event):
+        try:
+            bit = self._key_bits[event.key]
+        except KeyError:
+            bit = self._key_bits[event.key] = self._tracked_key_bit(event.key)
+        if self._on_raw_event is not None:
+            self._report_raw(ril.KEY_PRESS if event.pressed else ril.KEY_RELEASE,
+                             event, ril.NO_BIT if bit is None else bit)
+        if bit is None:
+            return
 
+        mouse_position, keys, mouse_buttons = self._state
         if event.pressed:
-            self._pressed_keys.add(key)
-        elif key in self._pressed_keys:
-            self._pressed_keys.remove(key)
-        new_pressed_keys_len = len(self._pressed_keys)
+            new_keys = keys | (1 << bit)
+        else:
+            new_keys = keys & ~(1 << bit)
 
         # if there was change
-        if new_pressed_keys_len != old_pressed_keys_len:
-            self._on_event(self.query())
+        if new_keys != keys:
+            self._state = (mouse_position, new_keys, mouse_buttons)
+            self._report(event)
 
     def _on_mouse_move_event(self, event):
-        self._mouse_position = event.position
-
-        difference = np.hypot(
-            self._mouse_position[0] - self._old_reported_position[0],
-            self._mouse_position[1] - self._old_reported_position[1])
-
-        if difference > ActionWatcher.noticeable_mouse_move_length:
-            self._old_reported_position = self._mouse_position
-            self._on_event(self.query())
+        position = event.position
+        _, keys, mouse_buttons = self._state
+        self._state = (position, keys, mouse_buttons)
+        if self._on_raw_event is not None:
+            self._report_raw_motion(event)
+
+        dx = position[0] - self._old_reported_position[0]
+        dy = position[1] - self._old_reported_position[1]
+        if dx * dx + dy * dy > ActionWatcher.noticeable_mouse_move_length ** 2:
+            self._old_reported_position = position
+            self._report(event)
 
     def _on_mouse_button_event(self, event):
-        button = event.button.lower()
-
-        old_pressed_btns_len = len(self._pressed_mouse_buttons)
+        try:
+            bit = self._button_bits[event.button]
+        except KeyError:
+            bit = self._button_bits[event.button] = ib.button_bit(event.button.lower())
+        if self._on_raw_event is not None:
+            self._report_raw(ril.BUTTON_PRESS if event.pressed else ril.BUTTON_RELEASE, event)
+        if bit is None:
+            return
 
+        mouse_position, keys, mouse_buttons = self._state
         if event.pressed:
-            self._pressed_mouse_buttons.add(button)
-        elif button in self._pressed_mouse_buttons:
-            self._pressed_mouse_buttons.remove(button)
-
-        new_pressed_btns_len = len(self._pressed_mouse_buttons)
+            new_buttons = mouse_buttons | (1 << bit)
+        else:
+            new_buttons = mouse_buttons & ~(1 << bit)
 
         # if there was change
-        if new_pressed_btns_len != old_pressed_btns_len:
-            self._on_event(self.query())
+        if new_buttons != mouse_buttons:
+            self._state = (mouse_position, keys, new_buttons)
+            self._report(event)
 
     def stop(self):
         if self._hook_thread.is_alive():
             self._hook_thread.cancel()
             self._hook_thread.join()
+            if self._on_raw_event is not None:
+                self._flush_motion()
+        self._streams.close()
 
     def start(self):
         self._hook_thread.start()
@@ -0,0 +1,114 @@
+import asyncio
+import collections
+import threading
+
+
+class AsyncStream:
+    # Async iterator over items produced by another thread.
+    # put() may be called from any thread and never blocks; the consumer is
+    # woken up with loop.call_soon_threadsafe, at most once per batch of items.
+    # Policies when the consumer falls behind:
+    #   "all"    - up to maxsize items are buffered, then the oldest is dropped
+    #   "latest" - only the newest item is kept
+    # Dropped items are counted in self.dropped.
+    # Iteration ends when the stream is closed and the buffer is drained.
+
+    policies = ("all", "latest")
+
+    def __init__(self, loop, maxsize=256, policy="all"):
+        if policy not in AsyncStream.policies:
+            raise ValueError("unknown policy {}".format(policy))
+        self.policy = policy
+        self.maxsize = 1 if policy == "latest" else maxsize
+
+        self._loop = loop
+        self._items = collections.deque()
+        self._lock = threading.Lock()
+        self._wakeup_pending = False
+        self._waiter = None  # future awaited by the consumer, used on the loop thread only
+        self._closed = False
+        self.dropped = 0
+
+    def put(self, item):
+        with self._lock:
+            if self._closed:
+                return
+            if len(self._items) >= self.maxsize:
+                self._items.popleft()
+                self.dropped += 1
+            self._items.append(item)
+            if self._wakeup_pending:
+                return
+            self._wakeup_pending = True
+        self._call_soon(self._wakeup)
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+        self._call_soon(self._wakeup)
+
+    def _call_soon(self, callback):
+        try:
+            self._loop.call_soon_threadsafe(callback)
+        except RuntimeError:
+            pass  # event loop is already closed, nobody is waiting
+
+    def _wakeup(self):
+        with self._lock:
+            self._wakeup_pending = False
+        if self._waiter is not None and not self._waiter.done():
+            self._waiter.set_result(None)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            with self._lock:
+                if self._items:
+                    return self._items.popleft()
+                if self._closed:
+                    raise StopAsyncIteration
+            self._waiter = self._loop.create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+
+
+class StreamHub:
+    # Fans items put by a producer thread out to the AsyncStreams of all
+    # current consumers. Consumers come and go on event loop threads, the set
+    # of streams is an immutable tuple replaced on every change, so put()
+    # needs no lock.
+
+    def __init__(self):
+        self._streams = ()
+        self._closed = False
+
+    def __bool__(self):
+        return len(self._streams) > 0
+
+    def put(self, item):
+        for stream in self._streams:
+            stream.put(item)
+
+    def close(self):
+        self._closed = True
+        for stream in self._streams:
+            stream.close()
+
+    async def subscribe(self, maxsize=256, policy="all"):
+        # async generator over the items put from now on, until close()
+        stream = AsyncStream(asyncio.get_running_loop(), maxsize, policy)
+        self._streams = self._streams + (stream,)
+        if self._closed:
+            stream.close()
+        try:
+            async for item in stream:
+                yield item
+        finally:
+            self._streams = tuple(s for s in self._streams if s is not stream)
+            stream.close()
@@ -0,0 +1,76 @@
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+
+import frame_writer as fw
+import frame_file as ff
+
+
+# Writes the same frames with every codec setting and prints encode speed
+# against compression ratio; round trips are tested in tests/test_frame_codec.py
+# usage: python benchmark_frame_codec.py [screen recording to take frames from]
+
+settings = [
+    (None, 0, 0),
+    ("zlib", 1, 40),
+    ("zlib", 6, 40),
+    ("zlib", 1, 200),
+    ("lzma", 0, 40),
+    ("lzma", 6, 40),
+]
+
+
+def synthetic_frames(n=400, shape=(96, 160, 3), seed=0):
+    # mostly static background with a few moving blocks, as in game footage
+    rng = np.random.default_rng(seed)
+    background = rng.integers(0, 255, shape, dtype=np.uint8)
+    frames = []
+    for i in range(n):
+        frame = background.copy()
+        for j in range(4):
+            row = (i * (j + 1)) % (shape[0] - 16)
+            col = (i * 3 + j * 40) % (shape[1] - 16)
+            frame[row:row + 16, col:col + 16] = 40 * j
+        if i % 100 == 99:
+            background = rng.integers(0, 255, shape, dtype=np.uint8)
+        frames.append(frame)
+    return frames
+
+
+def recorded_frames(filename, n=400):
+    frames = []
+    for record in ff.frame_generator(filename):
+        frames.append(record["frame"].copy())
+        if len(frames) == n:
+            break
+    return frames
+
+
+def run(frames):
+    raw_size = sum(frame.nbytes for frame in frames)
+    directory = tempfile.mkdtemp()
+    for compression, level, keyframe_interval in settings:
+        filename = os.path.join(directory, "{}_{}_{}{}".format(
+            compression, level, keyframe_interval, ff.extension))
+        writer = fw.FrameWriter(filename, compression=compression, level=level,
+                                keyframe_interval=keyframe_interval)
+        start = time.perf_counter()
+        for i, frame in enumerate(frames):
+            writer.add_to_write({"frame": frame, "time_ns": i, "monotonic_ns": i})
+        writer.close()
+        duration = time.perf_counter() - start
+
+        print("{:>5} level {} keyframes every {:>3}: {:8.1f} fps, ratio {:6.2f}".format(
+            str(compression), level, keyframe_interval,
+            len(frames) / duration, raw_size / os.path.getsize(filename)))
+        os.remove(filename)
+    os.rmdir(directory)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        run(recorded_frames(sys.argv[1]))
+    else:
+        run(synthetic_frames())
@@ -0,0 +1,97 @@
+import collections
+import threading
+
+
+class EventQueue:
+    # Bounded queue between a producer which must not be slowed down
+    # (X record thread) and a consumer thread running the callbacks.
+    # Overflow policies when the queue is full:
+    #   "block"           - producer waits for free space
+    #   "drop_oldest"     - oldest queued item is discarded
+    #   "coalesce_motion" - a motion item replaces a motion item at the end of
+    #                       the queue, otherwise it is discarded (both counted as
+    #                       coalesced); any other item takes the place of the
+    #                       oldest queued motion item, or waits for free space
+    #                       when there is none, so key and button items are
+    #                       never lost
+
+    overflow_policies = ("block", "drop_oldest", "coalesce_motion")
+
+    def __init__(self, maxsize=4096, overflow="block", is_motion=None):
+        if overflow not in EventQueue.overflow_policies:
+            raise ValueError("unknown overflow policy {}".format(overflow))
+        if is_motion is None:
+            is_motion = lambda item: False
+
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self._is_motion = is_motion
+
+        self._items = collections.deque()
+        self._condition = threading.Condition()
+        self._closed = False
+
+        self.dropped = 0
+        self.coalesced = 0
+        self._warned = False
+
+    def put(self, item):
+        with self._condition:
+            if len(self._items) >= self.maxsize:
+                if not self._warned:
+                    self._warned = True
+                    print("EventQueue full with {} events, overflow policy {}"
+                          .format(self.maxsize, self.overflow))
+                if self.overflow == "coalesce_motion":
+                    if self._is_motion(item):
+                        if self._is_motion(self._items[-1]):
+                            self._items[-1] = item
+                        self.coalesced += 1
+                        return
+                    if self._drop_oldest_motion():
+                        self.dropped += 1
+                if self.overflow == "drop_oldest":
+                    self._items.popleft()
+                    self.dropped += 1
+                while len(self._items) >= self.maxsize and not self._closed:
+                    self._condition.wait()
+
+            if self._closed:
+                return
+            self._items.append(item)
+            self._condition.notify_all()
+
+    def _drop_oldest_motion(self):
+        for i, queued in enumerate(self._items):
+            if self._is_motion(queued):
+                del self._items[i]
+                return True
+        return False
+
+    def get(self):
+        # next item, None when the queue is closed and drained
+        with self._condition:
+            while not self._items and not self._closed:
+                self._condition.wait()
+            if not self._items:
+                return None
+            item = self._items.popleft()
+            self._condition.notify_all()
+            return item
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    def __len__(self):
+        with self._condition:
+            return len(self._items)
+
+    def stats(self):
+        with self._condition:
+            return {
+                "pending": len(self._items),
+                "dropped": self.dropped,
+                "coalesced": self.coalesced
+            }
@@ -0,0 +1,52 @@
+import numpy as np
+
+
+class FrameDeduplicator:
+    # Detects frames which repeat the last kept frame, to store them as small
+    # "repeat_of" records instead of full frames.
+    # threshold = 0: a frame is new when any pixel differs
+    # threshold > 0: a frame is new when the mean absolute difference of every
+    #   step-th pixel in both directions is above threshold
+
+    def __init__(self, threshold=0, step=4):
+        self.threshold = threshold
+        self.step = step
+        self._last = None
+        self.repeated = 0
+
+    def _sample(self, frame):
+        if self.threshold == 0:
+            return frame
+        return frame[::self.step, ::self.step]
+
+    def is_new(self, frame):
+        sample = self._sample(frame)
+        if self._last is not None and self._last.shape == sample.shape:
+            if self.threshold == 0:
+                same = np.array_equal(sample, self._last)
+            else:
+                difference = np.abs(sample.astype(np.int16) - self._last)
+                same = difference.mean() <= self.threshold
+            if same:
+                self.repeated += 1
+                return False
+
+        if self._last is None or self._last.shape != sample.shape:
+            self._last = np.empty(sample.shape, dtype=sample.dtype)
+        np.copyto(self._last, sample)
+        return True
+
+    def forget(self):
+        # the next frame is new, for example after the last kept frame was
+        # discarded by the writer
+        self._last = None
+
+    def __call__(self, data):
+        # replaces the frame of a repeated record with a repeat marker, which
+        # the writer resolves to the index of the last written frame;
+        # returns True when the frame was kept
+        if self.is_new(data["frame"]):
+            return True
+        del data["frame"]
+        data["repeat_of"] = None
+        return False
@@ -0,0 +1,165 @@
+import datetime
+import lzma
+import os
+import struct
+import zlib
+import numpy as np
+
+# Binary container for screen recordings.
+# File layout: header, then a sequence of records
+#   header: magic, format version, compression, dtype string, frame shape
+#   record: index, wall clock timestamp (ns since epoch), monotonic clock timestamp (ns),
+#           kind, payload length, payload
+# Record kinds:
+#   raw    - payload is frame.tobytes()
+#   repeat - payload is the index of the last record with a frame, which is repeated
+#   key    - payload is the compressed frame.tobytes()
+#   delta  - payload is the compressed xor of the frame with the previous frame
+# Compressed files start with a key record and have one every keyframe_interval
+# frames, so that a frame can be decoded starting from the key record before it.
+
+extension = ".frames"
+
+MAGIC = b"TAFRAMES"
+VERSION = 3
+
+KIND_RAW = 0
+KIND_REPEAT = 1
+KIND_KEY = 2
+KIND_DELTA = 3
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_LZMA = 2
+compressions = {None: COMPRESSION_NONE, "zlib": COMPRESSION_ZLIB, "lzma": COMPRESSION_LZMA}
+
+_header_struct = struct.Struct("<8sBBBB")  # magic, version, compression, len(dtype str), ndim
+_dim_struct = struct.Struct("<I")
+record_struct = struct.Struct("<QqqBI")  # index, time_ns, monotonic_ns, kind, payload length
+repeat_struct = struct.Struct("<Q")
+
+
+def pack_header(dtype, shape, compression=COMPRESSION_NONE):
+    dtype_str = np.dtype(dtype).str.encode("ascii")
+    header = _header_struct.pack(MAGIC, VERSION, compression, len(dtype_str), len(shape))
+    header += dtype_str
+    header += b"".join(_dim_struct.pack(d) for d in shape)
+    return header
+
+
+def read_header(f):
+    # returns dtype, shape, compression; leaves file positioned at the first record
+    magic, version, compression, dtype_len, ndim = _header_struct.unpack(f.read(_header_struct.size))
+    if magic != MAGIC:
+        raise ValueError("{} is not a frames file".format(getattr(f, "name", f)))
+    if version != VERSION:
+        raise ValueError("unsupported frames file version {}".format(version))
+
+    dtype = np.dtype(f.read(dtype_len).decode("ascii"))
+    shape = tuple(_dim_struct.unpack(f.read(_dim_struct.size))[0] for _ in range(ndim))
+    return dtype, shape, compression
+
+
+def pack_record(index, time_ns, monotonic_ns, frame):
+    payload = np.ascontiguousarray(frame).tobytes()
+    return record_struct.pack(index, time_ns, monotonic_ns, KIND_RAW, len(payload)) + payload
+
+
+def pack_repeat_record(index, time_ns, monotonic_ns, repeat_of):
+    payload = repeat_struct.pack(repeat_of)
+    return record_struct.pack(index, time_ns, monotonic_ns, KIND_REPEAT, len(payload)) + payload
+
+
+def _compress(data, compression, level):
+    if compression == COMPRESSION_ZLIB:
+        return zlib.compress(data, level)
+    return lzma.compress(data, preset=level)
+
+
+def _decompress(data, compression):
+    if compression == COMPRESSION_ZLIB:
+        return zlib.decompress(data)
+    return lzma.decompress(data)
+
+
+class FrameEncoder:
+    # Produces key and delta records for consecutive frames.
+    # compression: "zlib" or "lzma", level: zlib level or lzma preset (0-9)
+
+    def __init__(self, compression="zlib", level=1, keyframe_interval=40):
+        if compression not in ("zlib", "lzma"):
+            raise ValueError("unknown compression {}".format(compression))
+        self.compression = compressions[compression]
+        self.level = level
+        self.keyframe_interval = keyframe_interval
+
+        self._previous = None
+        self._since_keyframe = 0
+
+    def pack_record(self, index, time_ns, monotonic_ns, frame):
+        frame = np.ascontiguousarray(frame)
+        if self._previous is None or self._since_keyframe >= self.keyframe_interval:
+            kind = KIND_KEY
+            data = frame.tobytes()
+            self._previous = np.empty_like(frame)
+            self._since_keyframe = 0
+        else:
+            kind = KIND_DELTA
+            # unchanged pixels become zeros, which compress well
+            data = np.bitwise_xor(frame, self._previous).tobytes()
+
+        np.copyto(self._previous, frame)
+        self._since_keyframe += 1
+
+        payload = _compress(data, self.compression, self.level)
+        return record_struct.pack(index, time_ns, monotonic_ns, kind, len(payload)) + payload
+
+
+def decode_frame(kind, payload, dtype, shape, compression, previous):
+    # frame of a raw, key or delta record, previous is the frame of the
+    # last record with a frame (needed for delta records)
+    if kind == KIND_RAW:
+        return np.frombuffer(payload, dtype).reshape(shape)
+    if kind == KIND_KEY:
+        return np.frombuffer(_decompress(payload, compression), dtype).reshape(shape)
+    if kind == KIND_DELTA:
+        delta = np.frombuffer(_decompress(payload, compression), dtype).reshape(shape)
+        return np.bitwise_xor(previous, delta)
+    raise ValueError("unknown record kind {}".format(kind))
+
+
+def ns_to_datetime_str(time_ns):
+    # same text as str(datetime.datetime.now()) which is used by JsonWriter
+    seconds, ns = divmod(time_ns, 10 ** 9)
+    dt = datetime.datetime.fromtimestamp(seconds)
+    return str(dt.replace(microsecond=ns // 1000))
+
+
+def frame_generator(filename):
+    # yields the same dicts as reading a json screen file line by line,
+    # repeat records are expanded into the frame they repeat
+    if os.path.getsize(filename) == 0:
+        return  # header is written together with the first frame
+    with open(filename, "rb") as f:
+        dtype, shape, compression = read_header(f)
+        frame = None
+        while True:
+            record_header = f.read(record_struct.size)
+            if len(record_header) < record_struct.size:
+                break  # end of file or a record truncated by an interrupted recording
+            index, time_ns, monotonic_ns, kind, length = record_struct.unpack(record_header)
+            payload = f.read(length)
+            if len(payload) < length:
+                break
+            # a repeat record always refers to the last record with a frame
+            if kind != KIND_REPEAT:
+                frame = decode_frame(kind, payload, dtype, shape, compression, frame)
+
+            yield {
+                "frame": frame,
+                "datetime": ns_to_datetime_str(time_ns),
+                "index": index,
+                "time_ns": time_ns,
+                "monotonic_ns": monotonic_ns
+            }
+    return
@@ -0,0 +1,83 @@
+import time
+import numpy as np
+
+
+class DeadlineScheduler:
+    # Paces a loop at fps with absolute deadlines on the monotonic clock,
+    # so the schedule does not drift when an iteration takes longer than usual.
+    # wait() sleeps until spin_time before the deadline and spins for the rest.
+    # When the deadline has already passed (overrun):
+    #   "skip"     - wait() returns at once and the missed periods are dropped,
+    #                the next deadline is the first one still in the future
+    #   "catch_up" - missed deadlines are kept, wait() returns at once until
+    #                the loop is back on schedule
+
+    spin_time = 0.002  # seconds
+
+    overrun_policies = ("skip", "catch_up")
+
+    def __init__(self, fps, overrun="skip"):
+        if overrun not in DeadlineScheduler.overrun_policies:
+            raise ValueError("unknown overrun policy {}".format(overrun))
+        self.overrun = overrun
+        self.period_ns = 0 if np.isinf(fps) else int(1e9 / fps)
+
+        self._deadline = None
+        # deadlines before this one are already counted as missed
+        self._counted_deadline = None
+        self._first_tick = None
+        self._last_tick = None
+        self.ticks = 0
+        self.missed = 0
+        self._lateness_sum = 0
+        self._lateness_sq_sum = 0
+
+    def wait(self):
+        now = time.monotonic_ns()
+        if self._deadline is None:
+            self._deadline = now
+            self._counted_deadline = now
+
+        if now < self._deadline:
+            sleep_ns = self._deadline - now - int(DeadlineScheduler.spin_time * 1e9)
+            if sleep_ns > 0:
+                time.sleep(sleep_ns / 1e9)
+            while now < self._deadline:
+                now = time.monotonic_ns()
+        elif self.period_ns > 0 and now - self._deadline >= self.period_ns:
+            missed = (now - self._deadline) // self.period_ns
+            # while catching up the deadline lags behind the ones counted before
+            first = max(self._deadline, self._counted_deadline)
+            if now - first >= self.period_ns:
+                new_missed = (now - first) // self.period_ns
+                self.missed += new_missed
+                self._counted_deadline = first + new_missed * self.period_ns
+            if self.overrun == "skip":
+                self._deadline += missed * self.period_ns
+
+        lateness = now - self._deadline
+        self._lateness_sum += lateness
+        self._lateness_sq_sum += lateness * lateness
+        self._deadline += self.period_ns
+
+        if self._first_tick is None:
+            self._first_tick = now
+        self._last_tick = now
+        self.ticks += 1
+
+    def stats(self):
+        # achieved fps, mean and standard deviation (jitter) of the wake up
+        # delay after the deadline in ms, number of missed deadlines
+        if self.ticks == 0:
+            return {"fps": 0.0, "lateness_ms": 0.0, "jitter_ms": 0.0, "missed": 0}
+
+        duration = self._last_tick - self._first_tick
+        fps = (self.ticks - 1) * 1e9 / duration if duration > 0 else 0.0
+        mean = self._lateness_sum / self.ticks
+        variance = max(self._lateness_sq_sum / self.ticks - mean * mean, 0)
+        return {
+            "fps": fps,
+            "lateness_ms": mean / 1e6,
+            "jitter_ms": variance ** 0.5 / 1e6,
+            "missed": self.missed
+        }
@@ -0,0 +1,163 @@
+import multiprocessing as mp
+import queue
+import signal
+import threading
+import time
+import cv2
+import numpy as np
+from multiprocessing import shared_memory
+
+
+class SharedFramePipeline:
+    # Converts captured frames in worker processes so that resizing does not
+    # compete for the GIL with input recording and writing.
+    # Raw BGRA captures are copied into shared memory input slots, workers
+    # resize and convert them into shared memory output slots of the same
+    # number, and only slot numbers and timestamps go through the process
+    # queues. Converted frames are passed to on_frame in capture order from a
+    # collector thread, as read only views with their "slot", which must be
+    # given back with release(slot) when the frame is no longer used.
+    # Workers are spawned, so the main script has to be import safe.
+
+    release_timeout = 5.0  # seconds close() waits for frames to be released
+
+    def __init__(self, capture_size, output_size, on_frame, slots=16, workers=2):
+        self._in_shape = (capture_size[1], capture_size[0], 4)
+        self._out_shape = (output_size[1], output_size[0], 3)
+        self.output_size = tuple(output_size)
+        self._on_frame = on_frame
+
+        self._in_shm = shared_memory.SharedMemory(
+            create=True, size=slots * int(np.prod(self._in_shape)))
+        self._out_shm = shared_memory.SharedMemory(
+            create=True, size=slots * int(np.prod(self._out_shape)))
+        self._in_frames = np.ndarray((slots, *self._in_shape), np.uint8, self._in_shm.buf)
+        self._out_frames = np.ndarray((slots, *self._out_shape), np.uint8, self._out_shm.buf)
+        self._out_views = []
+        for slot in range(slots):
+            view = self._out_frames[slot].view()
+            view.flags.writeable = False
+            self._out_views.append(view)
+
+        self._free_slots = queue.Queue()
+        for slot in range(slots):
+            self._free_slots.put(slot)
+
+        context = mp.get_context("spawn")
+        self._tasks = context.Queue()
+        self._results = context.Queue()
+        self._workers = [
+            context.Process(target=_convert_frames, daemon=True,
+                            args=(self._in_shm.name, self._out_shm.name, slots,
+                                  self._in_shape, self._out_shape,
+                                  self._tasks, self._results))
+            for _ in range(workers)]
+        self._collector = threading.Thread(target=self._collect)
+
+        self._slots = slots
+        self._sequence = 0
+        self._closed = False
+
+    def start(self):
+        for worker in self._workers:
+            worker.start()
+        self._collector.start()
+
+    def submit(self, frame, time_ns, monotonic_ns):
+        # called from the capture thread, returns False when the frame is skipped
+        # because all slots are in use
+        try:
+            slot = self._free_slots.get_nowait()
+        except queue.Empty:
+            return False
+
+        np.copyto(self._in_frames[slot], frame)
+        self._tasks.put((self._sequence, slot, time_ns, monotonic_ns))
+        self._sequence += 1
+        return True
+
+    def release(self, slot):
+        self._free_slots.put(slot)
+
+    def _collect(self):
+        # results come back in any order, frames are passed on in sequence order
+        pending = {}
+        next_sequence = 0
+        finished_workers = 0
+        while finished_workers < len(self._workers):
+            result = self._results.get()
+            if result is None:
+                finished_workers += 1
+                continue
+
+            pending[result[0]] = result
+            while next_sequence in pending:
+                _, slot, time_ns, monotonic_ns = pending.pop(next_sequence)
+                next_sequence += 1
+                self._on_frame({"frame": self._out_views[slot], "slot": slot,
+                                "time_ns": time_ns, "monotonic_ns": monotonic_ns})
+
+    def close(self):
+        # lets workers finish the submitted frames, then frees shared memory
+        if self._closed:
+            return
+        self._closed = True
+
+        for _ in self._workers:
+            self._tasks.put(None)
+        for worker in self._workers:
+            worker.join()
+        if self._collector.is_alive():
+            self._collector.join()
+
+        # frames handed out may still be used, for example queued for writing
+        deadline = time.monotonic() + self.release_timeout
+        while self._free_slots.qsize() < self._slots and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        # the names are removed anyway, the memory itself is unmapped only
+        # when nothing refers to it any more
+        del self._in_frames, self._out_frames, self._out_views
+        for shm in (self._in_shm, self._out_shm):
+            shm.unlink()
+            try:
+                shm.close()
+            except BufferError:
+                pass
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _convert_frames(in_name, out_name, slots, in_shape, out_shape, tasks, results):
+    # worker process: BGRA input slot -> resized BGR output slot
+    # Ctrl-C is handled by the parent, which shuts the workers down in order
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    in_shm = shared_memory.SharedMemory(name=in_name)
+    out_shm = shared_memory.SharedMemory(name=out_name)
+    in_frames = np.ndarray((slots, *in_shape), np.uint8, in_shm.buf)
+    out_frames = np.ndarray((slots, *out_shape), np.uint8, out_shm.buf)
+    output_size = (out_shape[1], out_shape[0])
+    resized = np.empty((out_shape[0], out_shape[1], 4), dtype=np.uint8)
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        slot = task[1]
+        frame = in_frames[slot]
+        if frame.shape[:2] != out_shape[:2]:
+            frame = cv2.resize(src=frame, dsize=output_size, dst=resized,
+                               interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(frame, cv2.COLOR_BGRA2BGR, dst=out_frames[slot])
+        results.put(task)
+
+    results.put(None)
+    del in_frames, out_frames
+    in_shm.close()
+    out_shm.close()
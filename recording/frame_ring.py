@@ -0,0 +1,44 @@
+import collections
+import threading
+import numpy as np
+
+
+class FrameRing:
+    # Fixed number of preallocated frame buffers reused for every captured frame.
+    # The producer acquires a free slot and fills buffer(slot), consumers get a
+    # read only view(slot) and must release(slot) once they are done with it.
+
+    def __init__(self, slots, shape, dtype=np.uint8):
+        self._buffers = [np.empty(shape, dtype) for _ in range(slots)]
+        self._views = []
+        for buffer in self._buffers:
+            view = buffer.view()
+            view.flags.writeable = False
+            self._views.append(view)
+
+        self._free = collections.deque(range(slots))
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buffers)
+
+    def acquire(self):
+        # index of a free slot, None if all of them are in use
+        with self._lock:
+            if not self._free:
+                return None
+            return self._free.popleft()
+
+    def buffer(self, slot):
+        return self._buffers[slot]
+
+    def view(self, slot):
+        return self._views[slot]
+
+    def release(self, slot):
+        with self._lock:
+            self._free.append(slot)
+
+    def free_slots(self):
+        with self._lock:
+            return len(self._free)
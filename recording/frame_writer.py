@@ -0,0 +1,32 @@
+import json_writer as jw
+import frame_file as ff
+
+
+class FrameWriter(jw.JsonWriter):
+    # writes screen records into the binary frames container instead of json lines
+    # (see frame_file for the layout), records must contain a "frame" ndarray
+    # or a "repeat_of" index, see FrameDeduplicator
+    # compression: None stores raw frames, "zlib" or "lzma" store key frames and
+    # compressed deltas between frames, see frame_file.FrameEncoder
+
+    def __init__(self, filename, compression=None, level=1, keyframe_interval=40):
+        super().__init__(filename)
+        self._header_written = False
+        self._compression = ff.compressions[compression]
+        self._encoder = None
+        if compression is not None:
+            self._encoder = ff.FrameEncoder(compression, level, keyframe_interval)
+
+    def _serialize(self, d):
+        if "frame" not in d:
+            return ff.pack_repeat_record(d["index"], d["time_ns"], d["monotonic_ns"], d["repeat_of"])
+
+        frame = d["frame"]
+        if self._encoder is None:
+            record = ff.pack_record(d["index"], d["time_ns"], d["monotonic_ns"], frame)
+        else:
+            record = self._encoder.pack_record(d["index"], d["time_ns"], d["monotonic_ns"], frame)
+        if not self._header_written:
+            self._header_written = True
+            return ff.pack_header(frame.dtype, frame.shape, self._compression) + record
+        return record
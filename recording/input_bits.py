@@ -0,0 +1,82 @@
+import threading
+
+# Bit ids of tracked keys and mouse buttons, used to store the pressed
+# keys and buttons of an input state as integer masks (see action_log).
+# Key names are the casefolded names reported by pyxhook. Common keys have
+# fixed bits, any other key gets the next free bit when it is first seen, so
+# every key keeps a bit of its own; the action log header stores the names of
+# all bits. Only when all key_capacity bits are taken further keys share the
+# "other" bit.
+
+# default substrings of the tracked control key names, see ActionWatcher.interesting_keys
+interesting_keys = ("esc", "space", "alt", "tab", "shift", "control",
+                    "caps", "left", "right", "up", "down")
+
+key_capacity = 64  # bits of the keys mask of an action log row
+
+# grows when keys are first seen, see key_bit
+key_names = (
+    list("abcdefghijklmnopqrstuvwxyz") +
+    ["escape", "space", "tab", "caps_lock", "shift_l", "shift_r",
+     "control_l", "control_r", "alt_l", "alt_r", "left", "right", "up", "down",
+     "other"]
+)
+
+# bit of a button is its X button number - 1, buttons without a name are
+# named "mouse <number> " by pyxhook
+button_names = ("mouse left", "mouse middle", "mouse right",
+                "mouse wheel up", "mouse wheel down") + \
+               tuple("mouse {} ".format(number) for number in range(6, 33))
+
+_key_bits = {name: bit for bit, name in enumerate(key_names)}
+_button_bits = {name: bit for bit, name in enumerate(button_names)}
+_key_bits_lock = threading.Lock()
+
+
+def key_bit(name):
+    bit = _key_bits.get(name)
+    if bit is not None:
+        return bit
+    with _key_bits_lock:
+        bit = _key_bits.get(name)
+        if bit is None:
+            if len(key_names) < key_capacity:
+                bit = len(key_names)
+                key_names.append(name)
+            else:
+                bit = _key_bits["other"]
+            _key_bits[name] = bit
+    return bit
+
+
+def button_bit(name):
+    # None for buttons which do not fit into the mask
+    return _button_bits.get(name)
+
+
+def key_mask(names):
+    mask = 0
+    for name in names:
+        mask |= 1 << key_bit(name)
+    return mask
+
+
+def button_mask(names):
+    mask = 0
+    for name in names:
+        bit = button_bit(name)
+        if bit is not None:
+            mask |= 1 << bit
+    return mask
+
+
+def mask_names(mask, names):
+    # names of the bits set in mask, names of bits past the table are numbers
+    result = []
+    bit = 0
+    while mask:
+        if mask & 1:
+            result.append(names[bit] if bit < len(names) else str(bit))
+        mask >>= 1
+        bit += 1
+    return result
@@ -1,57 +1,208 @@
 import threading
-import datetime
+import collections
+import time
 import json
+import numpy as np
+
+import frame_file as ff
 
 
 class JsonWriter:
     # class to sequentially write json objects
+    # Records are queued by add_to_write and serialized by a single writer
+    # thread, which writes them in batches and flushes the file periodically.
+    # The queue is limited by memory_budget bytes: when it is full, add_to_write
+    # blocks (overflow = "block") or discards the record (overflow = "drop",
+    # counted in self.dropped). Repeat records (see FrameDeduplicator) after a
+    # discarded frame are discarded too, as the frame they repeat is missing.
+
+    max_batch_len = 1000  # records per single file write
+    flush_interval = 1.0  # seconds
+    flush_size = 1 << 20  # flush after this many bytes are written
+    memory_budget = 256 << 20  # bytes of queued records
+    overflow = "block"
+    file_mode = "wb"
 
-    max_cache_len = 1000
+    overflow_policies = ("block", "drop")
 
-    def __init__(self, filename, json_encoder=json.JSONEncoder):
+    def __init__(self, filename, json_encoder=json.JSONEncoder,
+                 memory_budget=None, overflow=None):
         self._filename = filename
-        self._file = open(filename, "w")
-        self._cache = []
-        self._write_lock = threading.Lock()
-        self._cache_copy_lock = threading.Lock()
+        self._file = open(filename, self.file_mode)
         self._index = 0
+        # index of the last record with a frame, see FrameDeduplicator
+        self._last_frame_index = None
         self.json_encoder = json_encoder
 
-    def add_to_write(self, data):
-        data["datetime"] = str(datetime.datetime.now())
+        if memory_budget is not None:
+            self.memory_budget = memory_budget
+        if overflow is not None:
+            self.overflow = overflow
+        if self.overflow not in JsonWriter.overflow_policies:
+            raise ValueError("unknown overflow policy {}".format(self.overflow))
 
-        with self._cache_copy_lock:
-            if len(self._cache) >= JsonWriter.max_cache_len:
-                cache_copy = self._cache[:]
-                self._cache = []
-                self.async_write(cache_copy)
+        self._queue = collections.deque()
+        self._queued_bytes = 0
+        self._condition = threading.Condition()
+        self._closed = False
+        self.dropped = 0
+        # whether the last record with a frame was queued, repeat records are
+        # only queued after one
+        self._frame_queued = False
 
-        self._cache.append(data)
+        # daemon so that a writer which was never closed does not hang the exit
+        self._write_thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._write_thread.start()
 
-    def async_write(self, data):
-        write_thread = threading.Thread(target=lambda: self._write(data))
-        write_thread.start()
+    def add_to_write(self, data, on_written=None):
+        # on_written is called without arguments once the record is written
+        # or discarded, for example to give back a buffer the record refers to
+        # producers stamp records at capture time, records without
+        # timestamps are stamped here
+        # snapshots such as action_watcher.InputState are written as their record
+        # returns False when the record was discarded, see overflow
+        if not isinstance(data, dict):
+            data = data.as_record()
+        if "time_ns" not in data:
+            data["time_ns"] = time.time_ns()
+            data["monotonic_ns"] = time.monotonic_ns()
+        # kept for readers of older recordings
+        data["datetime"] = ff.ns_to_datetime_str(data["time_ns"])
+        if "frame" in data:
+            has_frame = True
+        elif "repeat_of" in data:
+            has_frame = False
+        else:
+            has_frame = None
+        return self._enqueue(data, JsonWriter._record_size(data), on_written, has_frame)
 
-    def _write(self, data):
-        with self._write_lock:
-            self._unsafe_write(data)
+    def _enqueue(self, data, size, on_written, has_frame=None):
+        # has_frame: True for records with a frame, False for repeat records,
+        # None for records of other kinds
+        with self._condition:
+            if self._closed:
+                raise ValueError("JsonWriter {} is closed".format(self._filename))
 
-    def _write_and_close_if_open(self, data):
-        with self._write_lock:
-            if self._file.closed:
-                return
-            self._unsafe_write(data)
-            self._file.close()
+            if has_frame is False and not self._frame_queued:
+                # the frame this repeats was discarded, so is the repeat
+                self.dropped += 1
+                if on_written is not None:
+                    on_written()
+                return False
+
+            # a record is always accepted into an empty queue, however big it is
+            while self._queue and self._queued_bytes + size > self.memory_budget:
+                if self.overflow == "drop":
+                    self.dropped += 1
+                    if has_frame:
+                        self._frame_queued = False
+                    if on_written is not None:
+                        on_written()
+                    return False
+                self._condition.wait()
+                if self._closed:
+                    # the writer thread stopped, the queue is never emptied
+                    if on_written is not None:
+                        on_written()
+                    raise ValueError("JsonWriter {} is closed".format(self._filename))
+
+            self._queue.append((data, size, on_written))
+            self._queued_bytes += size
+            if has_frame:
+                self._frame_queued = True
+            self._condition.notify_all()
+            return True
+
+    @staticmethod
+    def _record_size(data):
+        # rough memory used by a queued record, dominated by arrays
+        size = 256
+        for value in data.values():
+            if isinstance(value, np.ndarray):
+                size += value.nbytes
+        return size
+
+    def _write_loop(self):
+        try:
+            self._unsafe_write_loop()
+        finally:
+            # on a write error producers must not wait for the queue forever,
+            # records which are not written any more are discarded
+            with self._condition:
+                self._closed = True
+                batch = list(self._queue)
+                self._queue.clear()
+                self._condition.notify_all()
+            self._discard(batch)
+
+    def _unsafe_write_loop(self):
+        unflushed = 0
+        last_flush = time.monotonic()
+
+        while True:
+            with self._condition:
+                while not self._queue and not self._closed:
+                    if unflushed and time.monotonic() - last_flush >= self.flush_interval:
+                        break
+                    timeout = self.flush_interval if unflushed else None
+                    self._condition.wait(timeout)
 
-    def _unsafe_write(self, data):
+                batch = [self._queue.popleft()
+                         for _ in range(min(len(self._queue), self.max_batch_len))]
+                finished = self._closed and not self._queue
+
+            if batch:
+                try:
+                    chunk = self._serialize_batch([d for d, _, _ in batch])
+                    self._file.write(chunk)
+                    unflushed += len(chunk)
+                finally:
+                    self._discard(batch)
+
+            now = time.monotonic()
+            if unflushed and (finished or unflushed >= self.flush_size or
+                              now - last_flush >= self.flush_interval):
+                self._file.flush()
+                unflushed = 0
+                last_flush = now
+
+            if finished:
+                break
+
+    def _discard(self, batch):
+        # batch of queue entries which was written or will never be
+        for _, _, on_written in batch:
+            if on_written is not None:
+                on_written()
+        with self._condition:
+            self._queued_bytes -= sum(size for _, size, _ in batch)
+            self._condition.notify_all()
+
+    def _serialize_batch(self, data):
+        parts = []
         for d in data:
             d["index"] = self._index
+            if "frame" in d:
+                self._last_frame_index = self._index
+            elif "repeat_of" in d and d["repeat_of"] is None:
+                d["repeat_of"] = self._last_frame_index
             self._index += 1
-            self._file.write(json.dumps(d, cls=self.json_encoder) + "\n")
-            self._file.flush()
+            parts.append(self._serialize(d))
+        return b"".join(parts)
+
+    def _serialize(self, d):
+        return (json.dumps(d, cls=self.json_encoder) + "\n").encode()
 
     def close(self):
-        self._write_and_close_if_open(self._cache)
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+        if self._write_thread.is_alive() and \
+                self._write_thread is not threading.current_thread():
+            self._write_thread.join()
+        if not self._file.closed:
+            self._file.close()
 
     def __del__(self):
         print("JsonWriter {} __del__".format(self._filename))
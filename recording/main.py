@@ -1,44 +1,82 @@
+import asyncio
+import contextlib
 import time
 import cv2
-import numpy as np
 import datetime
 import json
 
 import action_watcher as aw
 import screencapture as sc
 import json_writer as jw
+import frame_writer as fw
+import action_log as al
+import action_log_writer as alw
+import raw_input_log as ril
+import raw_input_writer as riw
+import frame_file as ff
+import frame_dedup as fd
 import numpy_json as nj
+import video_file as vf
+import video_writer as vw
 import window_query
 
 
 genymotion_panel_size = 52
-offset, size = window_query.query()
-size = (size[0]-genymotion_panel_size, size[1])
 
 # dim_to_save = tuple([d // 2 for d in dim])
 dim_to_save = (160, 96)
-print(offset, size)
+capture_fps = 40
 
+# where frames are written: "frames" (binary frames container, see frame_file),
+# "video" (video container with a timestamp sidecar, see video_file) or "json"
+screen_sink = "frames"
 
+# > 0 to resize captured frames in that many worker processes, see SharedFramePipeline
+conversion_workers = 0
+
+# mean absolute difference of sampled pixels below which a frame is stored as a
+# repeat of the previous one, 0 only drops exact repeats
+repeat_threshold = 0
+
+# "frames" sink: None stores raw frames, "zlib" or "lzma" store key frames and
+# compressed deltas
+screen_compression = "zlib"
+
+# also record every key, button and motion event with X server timestamps,
+# see ActionWatcher raw mode
+record_raw_input = True
+# motion events closer in time than this are coalesced, 0 keeps all of them
+raw_motion_window_ms = 0
+
+# input events waiting for the dispatcher thread; when it is full, motion
+# events are coalesced instead of stalling the X record thread (see EventQueue),
+# and the raw log misses them (counted in the queue stats)
+input_queue_size = 1 << 16
 
 last_time_screenshot = time.time()
 last_time_action = time.time()
-image = np.random.rand(*dim_to_save, 3) * 255
-image = image.astype(np.uint8)
 
 
-def run(screen_writer, actions_writer):
+def run(screen_writer, actions_writer, raw_input_writer=None):
+    deduplicator = fd.FrameDeduplicator(threshold=repeat_threshold)
+
     def screenshot_filter(data):
-        global last_time_screenshot, image
+        global last_time_screenshot
         dt = time.time() - last_time_screenshot
         print("screenshot frequency {}".format(1 / dt))
         last_time_screenshot = time.time()
 
-        data["frame"] = cv2.resize(src=data["frame"],
-                                   dsize=dim_to_save, interpolation=cv2.INTER_AREA)
-        image = data["frame"]
+        # frame is already resized by the capturer and lives in its ring buffer
+        # until the writer is done with it
+        slot = data.pop("slot")
 
-        screen_writer.add_to_write(data)
+        if deduplicator(data):
+            if not screen_writer.add_to_write(data, on_written=lambda: screenshot_taker.release(slot)):
+                # the writer discarded the frame, so the next one must not repeat it
+                deduplicator.forget()
+        else:
+            screenshot_taker.release(slot)
+            screen_writer.add_to_write(data)
 
     def action_filter(data):
         global last_time_action
@@ -47,51 +85,88 @@ def run(screen_writer, actions_writer):
         last_time_action = time.time()
         actions_writer.add_to_write(data)
 
-    actions_watcher = aw.ActionWatcher(on_event=action_filter)
+    on_raw_event = raw_input_writer.add_to_write if raw_input_writer is not None else None
+    actions_watcher = aw.ActionWatcher(on_event=action_filter,
+                                       queue_size=input_queue_size, overflow="coalesce_motion",
+                                       on_raw_event=on_raw_event,
+                                       motion_window_ms=raw_motion_window_ms)
     screenshot_taker = sc.ScreenCapturer(*offset, *size,
                                          on_screenshot=screenshot_filter,
-                                         cap_fps=40)
+                                         cap_fps=capture_fps, output_size=dim_to_save,
+                                         ring_size=16, workers=conversion_workers)
 
     actions_watcher.start()
     screenshot_taker.start()
 
     try:
-        while True:
-            time.sleep(0.0001)
-            cv2.imshow("image", cv2.resize(src=image, dsize=size, interpolation=cv2.INTER_NEAREST))
-            cv2.waitKey(1)
-
+        asyncio.run(preview(screenshot_taker))
     except KeyboardInterrupt:
         pass
 
     screenshot_taker.stop()
     actions_watcher.stop()
+    queue_stats = actions_watcher.queue_stats()
+    print("input events queue {}".format(queue_stats))
+    if raw_input_writer is not None and queue_stats["coalesced"] + queue_stats["dropped"] > 0:
+        print("raw input log misses {} motion events of a full input events queue"
+              .format(queue_stats["coalesced"] + queue_stats["dropped"]))
+    print("skipped frames {}".format(screenshot_taker.skipped_frames))
+    print("repeated frames {}".format(deduplicator.repeated))
+    print("capture pacing {}".format(screenshot_taker.pacing_stats()))
 
     cv2.destroyAllWindows()
 
 
-def trim(s):
-    return s.replace(" ", "_").replace(":", "_").replace(".", "_").replace("-", "_")
+async def preview(screenshot_taker):
+    # shows the latest frame, frames captured while the window is drawn are skipped
+    async for data in screenshot_taker.frames(policy="latest"):
+        cv2.imshow("image", cv2.resize(src=data["frame"], dsize=size, interpolation=cv2.INTER_NEAREST))
+        cv2.waitKey(1)
+
 
+def open_screen_writer(filename):
+    # filename without extension
+    if screen_sink == "video":
+        return vw.VideoWriter(filename + vf.extension, fps=capture_fps)
+    if screen_sink == "json":
+        return jw.JsonWriter(filename + ".txt", json_encoder=nj.NumpyEncoder)
+    if screen_sink == "frames":
+        return fw.FrameWriter(filename + ff.extension, compression=screen_compression)
+    raise ValueError("unknown screen sink {}".format(screen_sink))
 
-postfix = datetime.datetime.now()
-screen_filename = "data/screen_{}".format(postfix)
-actions_filename = "data/actions_{}".format(postfix)
-window_parameters_filename = "data/window_parameters_{}"\
-    .format(postfix)
 
-screen_filename = trim(screen_filename) + ".txt"
-actions_filename = trim(actions_filename) + ".txt"
-window_parameters_filename = \
-    trim(window_parameters_filename) + ".txt"
+def trim(s):
+    return s.replace(" ", "_").replace(":", "_").replace(".", "_").replace("-", "_")
 
-window_parameters = {
-    "offset": list(offset),
-    "size": list(size)
-}
-json.dump(window_parameters,
-          open(window_parameters_filename, "w"))
 
-with jw.JsonWriter(screen_filename, json_encoder=nj.NumpyEncoder) as screen_writer, \
-        jw.JsonWriter(actions_filename) as actions_writer:
-    run(screen_writer, actions_writer)
+# frame conversion workers import this module, so recording starts only when run as a script
+if __name__ == "__main__":
+    offset, size = window_query.query()
+    size = (size[0]-genymotion_panel_size, size[1])
+    print(offset, size)
+
+    postfix = datetime.datetime.now()
+    screen_filename = "data/screen_{}".format(postfix)
+    actions_filename = "data/actions_{}".format(postfix)
+    raw_input_filename = "data/inputs_{}".format(postfix)
+    window_parameters_filename = "data/window_parameters_{}"\
+        .format(postfix)
+
+    screen_filename = trim(screen_filename)
+    actions_filename = trim(actions_filename) + al.extension
+    raw_input_filename = trim(raw_input_filename) + ril.extension
+    window_parameters_filename = \
+        trim(window_parameters_filename) + ".txt"
+
+    window_parameters = {
+        "offset": list(offset),
+        "size": list(size)
+    }
+    json.dump(window_parameters,
+              open(window_parameters_filename, "w"))
+
+    with open_screen_writer(screen_filename) as screen_writer, \
+            alw.ActionLogWriter(actions_filename) as actions_writer, \
+            (riw.RawInputWriter(raw_input_filename) if record_raw_input
+             else contextlib.nullcontext()) as raw_input_writer:
+        run(screen_writer, actions_writer, raw_input_writer)
@@ -66,12 +66,35 @@ from __future__ import print_function
 import sys
 import re
 import time
+import struct
 import threading
+import collections
 
 from Xlib import X, XK, display
 from Xlib.ext import record
 from Xlib.protocol import rq
 
+from event_queue import EventQueue
+
+
+# Key, button and motion events share the 32 byte core event layout:
+# type, detail, sequence number, time, root, event, child,
+# root_x, root_y, event_x, event_y, state, same_screen, pad
+core_event_struct = struct.Struct("=BBHIIIIhhhhHBx")
+core_event_types = frozenset([X.KeyPress, X.KeyRelease, X.ButtonPress,
+                              X.ButtonRelease, X.MotionNotify])
+
+# the fields of a core event that the hook uses, and the host monotonic
+# time (ns) when the event was received from the server
+CoreEvent = collections.namedtuple("CoreEvent", ["type", "detail", "time", "root_x", "root_y",
+                                                 "received_ns"])
+
+
+def decode_core_event(data, offset, received_ns=0):
+    (event_type, detail, _sequence, event_time, _root, _window, _child,
+     root_x, root_y, _x, _y, _state, _same_screen) = core_event_struct.unpack_from(data, offset)
+    return CoreEvent(event_type & 0x7f, detail, event_time, root_x, root_y, received_ns)
+
 
 #######################################################################
 # #######################START CLASS DEF###############################
@@ -95,6 +118,10 @@ class HookManager(threading.Thread):
         threading.Thread.__init__(self)
         self.finished = threading.Event()
 
+        # set by enable_dispatch_thread
+        self.event_queue = None
+        self._dispatch_thread = None
+
         # Give these some initial values
         self.mouse_position_x = 0
         self.mouse_position_y = 0
@@ -143,6 +170,7 @@ class HookManager(threading.Thread):
         # Hook to our display.
         self.local_dpy = display.Display()
         self.record_dpy = display.Display()
+        self.keymap = KeyMap(self.local_dpy)
 
         self.mouse_buttons_map =   {
             1: "mouse left",
@@ -152,11 +180,30 @@ class HookManager(threading.Thread):
             4: "mouse wheel up"
         }
 
+    def enable_dispatch_thread(self, maxsize=4096, overflow="block"):
+        # Run the callbacks on a separate thread, the record thread then only
+        # decodes events and puts them into a bounded queue, so slow callbacks
+        # do not stall the X server. See EventQueue for the overflow policies.
+        # Must be called before start().
+        self.event_queue = EventQueue(
+            maxsize=maxsize, overflow=overflow,
+            is_motion=lambda event: event.type == X.MotionNotify)
+        self._dispatch_thread = threading.Thread(target=self._dispatch_events)
+
+    def _dispatch_events(self):
+        while True:
+            event = self.event_queue.get()
+            if event is None:
+                break
+            self.processevent(event)
+
     def run(self):
         # Check if the extension is present
         if not self.record_dpy.has_extension("RECORD"):
             print("RECORD extension not found", file=sys.stderr)
             sys.exit(1)
+        if self._dispatch_thread is not None:
+            self._dispatch_thread.start()
         # r = self.record_dpy.record_get_version(0, 0)
         # print("RECORD extension version {major}.{minor}".format(
         #     major=r.major_version,
@@ -172,7 +219,8 @@ class HookManager(threading.Thread):
                 'core_replies': (0, 0),
                 'ext_requests': (0, 0, 0, 0),
                 'ext_replies': (0, 0, 0, 0),
-                'delivered_events': (0, 0),
+                # keyboard mapping changes invalidate the keycode cache
+                'delivered_events': (X.MappingNotify, X.MappingNotify),
                 #                (X.KeyPress, X.ButtonPress),
                 'device_events': tuple(self.contextEventMask),
                 'errors': (0, 0),
@@ -187,6 +235,11 @@ class HookManager(threading.Thread):
         # Finally free the context
         self.record_dpy.record_free_context(self.ctx)
 
+        # let the dispatcher handle the queued events and finish
+        if self._dispatch_thread is not None:
+            self.event_queue.close()
+            self._dispatch_thread.join()
+
     def cancel(self):
         self.finished.set()
         self.local_dpy.record_disable_context(self.ctx)
@@ -235,51 +288,60 @@ class HookManager(threading.Thread):
             # not an event
             return
         data = reply.data
-        while len(data):
-            event, data = rq.EventField(None).parse_binary_value(
-                data,
-                self.record_dpy.display,
-                None,
-                None
-            )
-            if event.type == X.KeyPress:
-                hookevent = self.keypressevent(event)
-                self.processhookevents(self.KeyDown, self.KeyDownParameters, hookevent)
-            elif event.type == X.KeyRelease:
-                hookevent = self.keyreleaseevent(event)
-                self.processhookevents(self.KeyUp, self.KeyUpParameters, hookevent)
-            elif event.type == X.ButtonPress:
-                hookevent = self.buttonpressevent(event)
-                self.processhookevents(self.MouseAllButtonsDown, self.MouseAllButtonsDownParameters, hookevent)
-            elif event.type == X.ButtonRelease:
-                hookevent = self.buttonreleaseevent(event)
-                self.processhookevents(self.MouseAllButtonsUp, self.MouseAllButtonsUpParameters, hookevent)
-            elif event.type == X.MotionNotify:
-                # use mouse moves to record mouse position, since press and
-                # release events do not give mouse position info
-                # (event.root_x and event.root_y have bogus info).
-                hookevent = self.mousemoveevent(event)
-                self.processhookevents(self.MouseMovement, self.MouseMovementParameters, hookevent)
+        received_ns = time.monotonic_ns()
+        offset = 0
+        while offset < len(data):
+            if data[offset] & 0x7f in core_event_types:
+                # fast path, read the fields straight from the reply
+                event = decode_core_event(data, offset, received_ns)
+            else:
+                event, _ = rq.EventField(None).parse_binary_value(
+                    data[offset:offset + core_event_struct.size],
+                    self.record_dpy.display,
+                    None,
+                    None
+                )
+            offset += core_event_struct.size
+            if self.event_queue is not None:
+                self.event_queue.put(event)
+            else:
+                self.processevent(event)
+
+    def processevent(self, event):
+        if event.type == X.KeyPress:
+            hookevent = self.keypressevent(event)
+            self.processhookevents(self.KeyDown, self.KeyDownParameters, hookevent)
+        elif event.type == X.KeyRelease:
+            hookevent = self.keyreleaseevent(event)
+            self.processhookevents(self.KeyUp, self.KeyUpParameters, hookevent)
+        elif event.type == X.ButtonPress:
+            hookevent = self.buttonpressevent(event)
+            self.processhookevents(self.MouseAllButtonsDown, self.MouseAllButtonsDownParameters, hookevent)
+        elif event.type == X.ButtonRelease:
+            hookevent = self.buttonreleaseevent(event)
+            self.processhookevents(self.MouseAllButtonsUp, self.MouseAllButtonsUpParameters, hookevent)
+        elif event.type == X.MotionNotify:
+            # use mouse moves to record mouse position, since press and
+            # release events do not give mouse position info
+            # (event.root_x and event.root_y have bogus info).
+            hookevent = self.mousemoveevent(event)
+            self.processhookevents(self.MouseMovement, self.MouseMovementParameters, hookevent)
+        elif event.type == X.MappingNotify:
+            self.keymap.invalidate(event)
 
         # print("processing events...", event.type)
 
     def keypressevent(self, event):
-        matchto = self.lookup_keysym(
-            self.local_dpy.keycode_to_keysym(event.detail, 0)
-        )
-        if self.shiftablechar.match(
-                self.lookup_keysym(
-                    self.local_dpy.keycode_to_keysym(event.detail, 0))):
+        keysym, matchto = self.keymap.lookup(event.detail, 0)
+        if self.shiftablechar.match(matchto):
             # This is a character that can be typed.
             if not self.ison["shift"]:
-                keysym = self.local_dpy.keycode_to_keysym(event.detail, 0)
-                return self.makekeyhookevent(keysym, event)
+                return self.makekeyhookevent(matchto, event)
             else:
-                keysym = self.local_dpy.keycode_to_keysym(event.detail, 1)
-                return self.makekeyhookevent(keysym, event)
+                keysym, key = self.keymap.lookup(event.detail, 1)
+                return self.makekeyhookevent(key, event)
         else:
             # Not a typable character.
-            keysym = self.local_dpy.keycode_to_keysym(event.detail, 0)
             if self.isshift.match(matchto):
                 self.ison["shift"] = self.ison["shift"] + 1
             elif self.iscaps.match(matchto):
@@ -289,22 +351,15 @@ class HookManager(threading.Thread):
                 if self.ison["caps"]:
                     self.ison["shift"] = self.ison["shift"] - 1
                     self.ison["caps"] = False
-            return self.makekeyhookevent(keysym, event)
+            return self.makekeyhookevent(matchto, event)
 
     def keyreleaseevent(self, event):
-        if self.shiftablechar.match(
-                self.lookup_keysym(
-                    self.local_dpy.keycode_to_keysym(event.detail, 0))):
-            if not self.ison["shift"]:
-                keysym = self.local_dpy.keycode_to_keysym(event.detail, 0)
-            else:
-                keysym = self.local_dpy.keycode_to_keysym(event.detail, 1)
-        else:
-            keysym = self.local_dpy.keycode_to_keysym(event.detail, 0)
-        matchto = self.lookup_keysym(keysym)
+        keysym, matchto = self.keymap.lookup(event.detail, 0)
+        if self.shiftablechar.match(matchto) and self.ison["shift"]:
+            keysym, matchto = self.keymap.lookup(event.detail, 1)
         if self.isshift.match(matchto):
             self.ison["shift"] = self.ison["shift"] - 1
-        return self.makekeyhookevent(keysym, event)
+        return self.makekeyhookevent(matchto, event)
 
     def buttonpressevent(self, event):
         # self.clickx = self.rootx
@@ -336,24 +391,22 @@ class HookManager(threading.Thread):
         self.mouse_position_y = event.root_y
         return self.makemousehookevent(event)
 
-    # need the following because XK.keysym_to_string() only does printable
-    # chars rather than being the correct inverse of XK.string_to_keysym()
     def lookup_keysym(self, keysym):
-        for name in dir(XK):
-            if name.startswith("XK_") and getattr(XK, name) == keysym:
-                return name.lstrip("XK_")
-        return "[{}]".format(keysym)
+        return self.keymap.lookup_keysym(keysym)
 
     def asciivalue(self, keysym):
         asciinum = XK.string_to_keysym(self.lookup_keysym(keysym))
         return asciinum % 256
 
-    def makekeyhookevent(self, keysym, event):
+    def makekeyhookevent(self, key, event):
         pressed = (event.type == X.KeyPress)
 
         return SimplePyxhookKeyEvent(
             pressed=pressed,
-            key=self.lookup_keysym(keysym)
+            key=key,
+            time=event.time,
+            detail=event.detail,
+            received_ns=getattr(event, "received_ns", 0)
         )
 
     def makemousehookevent(self, event):
@@ -363,10 +416,65 @@ class HookManager(threading.Thread):
 
         button_event = (event.type == X.ButtonPress) or (event.type == X.ButtonRelease)
 
+        received_ns = getattr(event, "received_ns", 0)
         if button_event:
-            return SimplePyxhookMouseButtonEvent(button=button, pressed=(event.type == X.ButtonPress))
+            return SimplePyxhookMouseButtonEvent(button=button, pressed=(event.type == X.ButtonPress),
+                                                 time=event.time, detail=event.detail,
+                                                 received_ns=received_ns)
         else:
-            return SimplePyxhookMouseEvent(position=position)
+            return SimplePyxhookMouseEvent(position=position, time=event.time,
+                                           received_ns=received_ns)
+
+
+class KeyMap:
+    """ Keysym names and keycode translation used by HookManager.
+
+        The keysym -> name table is built once for all instances, and
+        (keycode, shift level) -> (keysym, name) lookups are cached.
+        The cache must be invalidated when the server reports a keyboard
+        mapping change with a MappingNotify event.
+    """
+
+    _keysym_names = None
+
+    def __init__(self, dpy):
+        self._dpy = dpy
+        self._lookup_cache = {}
+        KeyMap.keysym_names()  # build the table now rather than on the first key event
+
+    @classmethod
+    def keysym_names(cls):
+        # need the following because XK.keysym_to_string() only does printable
+        # chars rather than being the correct inverse of XK.string_to_keysym()
+        if cls._keysym_names is None:
+            names = {}
+            # dir() is sorted, first name wins for keysyms with several names
+            for name in dir(XK):
+                if name.startswith("XK_"):
+                    names.setdefault(getattr(XK, name), name.lstrip("XK_"))
+            cls._keysym_names = names
+        return cls._keysym_names
+
+    def lookup_keysym(self, keysym):
+        name = KeyMap.keysym_names().get(keysym)
+        if name is None:
+            return "[{}]".format(keysym)
+        return name
+
+    def lookup(self, keycode, level):
+        key = (keycode, level)
+        try:
+            return self._lookup_cache[key]
+        except KeyError:
+            keysym = self._dpy.keycode_to_keysym(keycode, level)
+            result = (keysym, self.lookup_keysym(keysym))
+            self._lookup_cache[key] = result
+            return result
+
+    def invalidate(self, event=None):
+        self._lookup_cache.clear()
+        if event is not None:
+            self._dpy.refresh_keyboard_mapping(event)
 
 
 class pyxhookkeyevent:
@@ -441,29 +549,40 @@ class pyxhookmouseevent:
         )).format(s=self)
 
 
+# time is the X server timestamp (ms), received_ns the host monotonic time (ns)
+# when the event was received, detail the keycode or button number
+
 class SimplePyxhookKeyEvent:
-    def __init__(self, key, pressed):
+    def __init__(self, key, pressed, time=0, detail=0, received_ns=0):
         self.key = key
         self.pressed = pressed
         self.released = not pressed
+        self.time = time
+        self.detail = detail
+        self.received_ns = received_ns
 
     def __str__(self):
         return "{} {}".format(self.key, "pressed" if self.pressed else "released")
 
 
 class SimplePyxhookMouseButtonEvent:
-    def __init__(self, button, pressed):
+    def __init__(self, button, pressed, time=0, detail=0, received_ns=0):
         self.button = button
         self.pressed = pressed
         self.released = not pressed
+        self.time = time
+        self.detail = detail
+        self.received_ns = received_ns
 
     def __str__(self):
         return "{} {}".format(self.button, "pressed" if self.pressed else "released")
 
 
 class SimplePyxhookMouseEvent:
-    def __init__(self, position):
+    def __init__(self, position, time=0, received_ns=0):
         self.position = position
+        self.time = time
+        self.received_ns = received_ns
 
     def __str__(self):
         return "Move at {}".format(self.position)
@@ -0,0 +1,70 @@
+import collections
+import os
+import struct
+import numpy as np
+
+# Raw input log, one packed record for every key, button and motion event.
+# File layout: header (magic, format version), then records
+#   record: host monotonic time when the event was received (ns),
+#           X server time (ms, wraps around after 49.7 days),
+#           event type (X event type, see below),
+#           detail (keycode or button number, 0 for motion),
+#           key bit (named in the action log header of the same recording,
+#           see input_bits, NO_BIT for untracked keys and other events),
+#           pointer x, y (root window coordinates)
+# The records are read at once as a numpy structured array.
+
+extension = ".inputs"
+
+MAGIC = b"TAINPUTS"
+VERSION = 1
+
+# X event types
+KEY_PRESS = 2
+KEY_RELEASE = 3
+BUTTON_PRESS = 4
+BUTTON_RELEASE = 5
+MOTION = 6
+
+NO_BIT = 255
+
+_header_struct = struct.Struct("<8sB")  # magic, version
+record_struct = struct.Struct("<qIBBBhh")
+record_dtype = np.dtype([("received_ns", "<i8"), ("server_time", "<u4"),
+                         ("type", "u1"), ("detail", "u1"), ("key_bit", "u1"),
+                         ("x", "<i2"), ("y", "<i2")])
+
+RawInputEvent = collections.namedtuple(
+    "RawInputEvent", ["received_ns", "server_time", "type", "detail", "key_bit", "x", "y"])
+
+
+def pack_header():
+    return _header_struct.pack(MAGIC, VERSION)
+
+
+def read_header(f):
+    magic, version = _header_struct.unpack(f.read(_header_struct.size))
+    if magic != MAGIC:
+        raise ValueError("{} is not a raw input log".format(getattr(f, "name", f)))
+    if version != VERSION:
+        raise ValueError("unsupported raw input log version {}".format(version))
+
+
+def pack_events(events):
+    return b"".join(record_struct.pack(*event) for event in events)
+
+
+def read_events(filename):
+    # records as a read only structured array mapped from the file,
+    # a record cut by an interrupted recording is ignored
+    if os.path.getsize(filename) == 0:
+        return np.zeros(0, dtype=record_dtype)  # header is written with the first record
+    with open(filename, "rb") as f:
+        read_header(f)
+        offset = f.tell()
+        f.seek(0, 2)
+        records = (f.tell() - offset) // record_dtype.itemsize
+
+    if records == 0:
+        return np.zeros(0, dtype=record_dtype)
+    return np.memmap(filename, dtype=record_dtype, mode="r", offset=offset, shape=(records,))
@@ -0,0 +1,24 @@
+import json_writer as jw
+import raw_input_log as ril
+
+
+class RawInputWriter(jw.JsonWriter):
+    # writes RawInputEvent tuples from ActionWatcher raw mode into the raw
+    # input log (see raw_input_log) instead of json lines
+
+    event_size = 128  # rough memory used by a queued event
+
+    def __init__(self, filename):
+        super().__init__(filename)
+        self._header_written = False
+
+    def add_to_write(self, event, on_written=None):
+        # events are queued as they are, they have their own timestamps
+        return self._enqueue(event, RawInputWriter.event_size, on_written)
+
+    def _serialize_batch(self, events):
+        data = ril.pack_events(events)
+        if not self._header_written:
+            self._header_written = True
+            return ril.pack_header() + data
+        return data
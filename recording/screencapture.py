@@ -4,36 +4,121 @@ import threading
 import time
 import numpy as np
 
+from frame_ring import FrameRing
+from frame_pacing import DeadlineScheduler
+from frame_pipeline import SharedFramePipeline
+from async_stream import StreamHub
+
 
 class ScreenCapturer:
-    def __init__(self, x, y, width, height, on_screenshot, cap_fps=np.inf):
+    # output_size: (width, height) frames are resized to, None keeps the captured size
+    # ring_size: with a positive value frames are written into that many
+    #   preallocated buffers and handed out as read only views, the record
+    #   passed to on_screenshot then has a "slot" which must be given back with
+    #   release(slot) when the frame is no longer used. Frames captured while
+    #   all buffers are in use are skipped and counted in skipped_frames.
+    # overrun: what to do when a capture takes longer than 1 / cap_fps,
+    #   see DeadlineScheduler
+    # workers: with a positive value frames are converted in that many worker
+    #   processes through shared memory (see SharedFramePipeline), records then
+    #   have a "slot" to release as in the ring_size mode, ring_size (16 if not
+    #   set) is the number of shared memory slots
+    # on_screenshot may be None when frames are consumed only with frames()
+
+    def __init__(self, x, y, width, height, on_screenshot=None, cap_fps=np.inf,
+                 output_size=None, ring_size=0, overrun="skip", workers=0):
         self._on_screenshot = on_screenshot
+        self._streams = StreamHub()
         self._screenshot_taker = cp.Capturer(x, y, width, height)
 
         self.cap_fps = cap_fps
-        self.last_time_screenshot = time.time()
+        self._scheduler = DeadlineScheduler(cap_fps, overrun=overrun)
         self._stop = False
 
+        if output_size is None or tuple(output_size) == (width, height):
+            self._resized = None
+            output_size = (width, height)
+        else:
+            # resized 4 channel frame, converted to 3 channels afterwards
+            self._resized = np.empty((output_size[1], output_size[0], 4), dtype=np.uint8)
+        self.output_size = tuple(output_size)
+        frame_shape = (output_size[1], output_size[0], 3)
+
+        self._ring = None
+        self._pipeline = None
+        if workers > 0:
+            self._pipeline = SharedFramePipeline((width, height), output_size, self._emit,
+                                                 slots=ring_size or 16, workers=workers)
+        elif ring_size > 0:
+            self._ring = FrameRing(ring_size, frame_shape)
+        self.skipped_frames = 0
+
         self._screenshot_thread = threading.Thread(target=self._take_screenshots)
 
     def start(self):
+        if self._pipeline is not None:
+            self._pipeline.start()
         self._screenshot_thread.start()
 
+    def release(self, slot):
+        if self._pipeline is not None:
+            self._pipeline.release(slot)
+        else:
+            self._ring.release(slot)
+
+    def frames(self, maxsize=16, policy="latest"):
+        # async iterator over captured records, "async for data in capturer.frames()",
+        # see AsyncStream for the policies; frames of the ring and worker modes
+        # are copied, so the records have no "slot"; ends when the capturer is stopped
+        return self._streams.subscribe(maxsize, policy)
+
+    def _emit(self, data):
+        if self._streams:
+            frame = data["frame"].copy() if "slot" in data else data["frame"]
+            self._streams.put({"frame": frame, "time_ns": data["time_ns"],
+                               "monotonic_ns": data["monotonic_ns"]})
+        if self._on_screenshot is not None:
+            self._on_screenshot(data)
+        elif "slot" in data:
+            self.release(data["slot"])
+
     def wait_before_next_shot(self):
-        period = 1 / self.cap_fps
-        dt = time.time() - self.last_time_screenshot
-        while dt < period:
-            dt = time.time() - self.last_time_screenshot
-        self.last_time_screenshot = time.time()
+        self._scheduler.wait()
+
+    def pacing_stats(self):
+        # achieved fps, jitter and missed deadlines, see DeadlineScheduler.stats
+        return self._scheduler.stats()
+
+    def _convert(self, frame, out=None):
+        # BGRA capture -> BGR frame of output_size, written into out if given
+        if self._resized is not None:
+            # resizing first makes the conversion work on the small frame
+            frame = cv2.resize(src=frame, dsize=self.output_size, dst=self._resized,
+                               interpolation=cv2.INTER_AREA)
+        return cv2.cvtColor(frame, cv2.COLOR_BGRA2BGR, dst=out)
 
     def _take_screenshots(self):
         while True:
             self.wait_before_next_shot()
 
             frame = self._screenshot_taker.get_fast_screenshot()
-            [b, g, r, a] = cv2.split(frame)
-            frame = cv2.merge([b, g, r])
-            self._on_screenshot({"frame": frame})
+            time_ns = time.time_ns()
+            monotonic_ns = time.monotonic_ns()
+
+            if self._pipeline is not None:
+                if not self._pipeline.submit(frame, time_ns, monotonic_ns):
+                    self.skipped_frames += 1
+            elif self._ring is None:
+                self._emit({"frame": self._convert(frame), "time_ns": time_ns,
+                            "monotonic_ns": monotonic_ns})
+            else:
+                slot = self._ring.acquire()
+                if slot is None:
+                    self.skipped_frames += 1
+                else:
+                    self._convert(frame, out=self._ring.buffer(slot))
+                    self._emit({"frame": self._ring.view(slot), "slot": slot,
+                                "time_ns": time_ns, "monotonic_ns": monotonic_ns})
             if self._stop:
                 break
 
@@ -41,6 +126,9 @@ class ScreenCapturer:
         self._stop = True
         if self._screenshot_thread.is_alive():
             self._screenshot_thread.join()
+        if self._pipeline is not None:
+            self._pipeline.close()
+        self._streams.close()
 
     def __del__(self):
         self.stop()
@@ -51,4 +139,3 @@ class ScreenCapturer:
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.stop()
-
@@ -0,0 +1,67 @@
+import cv2
+import numpy as np
+
+# Screen recordings stored in a video container.
+# The video holds only the distinct frames, in order. A sidecar file next to
+# it has one fixed size row per screen record:
+#   index, wall clock timestamp (ns since epoch), monotonic clock timestamp (ns),
+#   number of the video frame shown at that time
+# Repeated frames (see FrameDeduplicator) are rows pointing at the same video frame.
+
+extension = ".avi"
+sidecar_postfix = ".timestamps"
+
+sidecar_dtype = np.dtype([("index", "<i8"), ("time_ns", "<i8"),
+                          ("monotonic_ns", "<i8"), ("video_frame", "<i8")])
+
+# tried in order, the first one available in the opencv build is used;
+# MJPG is lossy and only a last resort
+codecs = ("FFV1", "png ", "MJPG")
+lossless_codecs = ("FFV1", "png ")
+
+
+def sidecar_filename(filename):
+    return filename + sidecar_postfix
+
+
+def open_video_writer(filename, fps, frame_size, codecs=codecs):
+    # returns the opened cv2.VideoWriter and the fourcc it uses
+    for codec in codecs:
+        writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*codec), fps, frame_size)
+        if writer.isOpened():
+            return writer, codec
+        writer.release()
+    raise ValueError("none of the codecs {} can write {}".format(codecs, filename))
+
+
+def read_sidecar(filename):
+    # rows of the sidecar, a row cut by an interrupted recording is ignored
+    with open(sidecar_filename(filename), "rb") as f:
+        data = f.read()
+    rows = len(data) // sidecar_dtype.itemsize
+    return np.frombuffer(data, sidecar_dtype, count=rows)
+
+
+def read_frames(filename):
+    # yields (index, time_ns, monotonic_ns, frame) for every sidecar row,
+    # repeated frames are the same array
+    rows = read_sidecar(filename)
+    if len(rows) == 0:
+        return
+
+    capture = cv2.VideoCapture(filename)
+    if not capture.isOpened():
+        raise ValueError("cannot open video {}".format(filename))
+    try:
+        frame = None
+        decoded = -1  # number of the last decoded video frame
+        for index, time_ns, monotonic_ns, video_frame in rows.tolist():
+            while decoded < video_frame:
+                ok, frame = capture.read()
+                if not ok:
+                    return  # video cut by an interrupted recording
+                decoded += 1
+            yield index, time_ns, monotonic_ns, frame
+    finally:
+        capture.release()
+    return
@@ -0,0 +1,44 @@
+import numpy as np
+
+import json_writer as jw
+import video_file as vf
+
+
+class VideoWriter(jw.JsonWriter):
+    # writes screen records into a video container with a timestamp sidecar
+    # (see video_file for the layout) instead of json lines;
+    # records must contain a "frame" ndarray (3 channel uint8) or a "repeat_of"
+    # index, see FrameDeduplicator
+    # the video is opened with the first frame, whose size all frames must have
+
+    def __init__(self, filename, fps, codecs=vf.codecs):
+        # the file written by JsonWriter is the sidecar
+        super().__init__(vf.sidecar_filename(filename))
+        self._video_filename = filename
+        self._fps = fps
+        self._codecs = codecs
+        self._video = None
+        self.codec = None
+        self._video_frame = -1  # number of the last frame written to the video
+
+    def _serialize(self, d):
+        if "frame" in d:
+            frame = d["frame"]
+            if self._video is None:
+                self._video, self.codec = vf.open_video_writer(
+                    self._video_filename, self._fps, frame.shape[1::-1], self._codecs)
+                if self.codec not in vf.lossless_codecs:
+                    print("VideoWriter {}: no lossless codec available, using {}"
+                          .format(self._video_filename, self.codec))
+            self._video.write(frame)
+            self._video_frame += 1
+
+        row = np.array((d["index"], d["time_ns"], d["monotonic_ns"], self._video_frame),
+                       dtype=vf.sidecar_dtype)
+        return row.tobytes()
+
+    def close(self):
+        super().close()
+        if self._video is not None:
+            self._video.release()
+            self._video = None
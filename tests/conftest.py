@@ -0,0 +1,8 @@
+import os
+import sys
+
+# ml modules import the recording package, recording modules import each other
+# as top level modules as when recording/main.py is run
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+sys.path.insert(0, os.path.join(root, "recording"))
@@ -0,0 +1,50 @@
+import pytest
+
+import pyxhook
+import action_watcher as aw
+
+
+class FakeHookManager:
+    # stands in for the X record thread, events are passed to the handlers directly
+    event_queue = None
+
+    def is_alive(self):
+        return False
+
+
+@pytest.fixture
+def watchers(monkeypatch):
+    monkeypatch.setattr(pyxhook, "HookManager", FakeHookManager)
+
+    def make():
+        states = []
+        watcher = aw.ActionWatcher(on_event=states.append)
+        return watcher, states
+    return make
+
+
+def key(watcher, name, pressed):
+    watcher._on_key_event(pyxhook.SimplePyxhookKeyEvent(name, pressed, received_ns=1))
+
+
+def test_keys_have_own_bits(watchers):
+    watcher, states = watchers()
+    key(watcher, "KP_Up", True)
+    key(watcher, "Page_Up", True)
+    key(watcher, "Page_Up", False)
+    assert [state.key_names for state in states] == [["kp_up"], ["kp_up", "page_up"], ["kp_up"]]
+
+
+def test_interesting_keys_per_watcher(watchers):
+    watcher, states = watchers()
+    other, other_states = watchers()
+    key(watcher, "F1", True)
+    key(other, "F1", True)
+    assert states == [] and other_states == []
+
+    # tracked keys are decided again after a change, for this watcher only
+    watcher.interesting_keys = watcher.interesting_keys + ["f1"]
+    key(watcher, "F1", True)
+    key(other, "F1", True)
+    assert [state.key_names for state in states] == [["f1"]]
+    assert other_states == []
@@ -0,0 +1,202 @@
+import json
+import os
+import datetime
+import numpy as np
+import pytest
+
+from recording import numpy_json as nj
+from ml import data_processing as dp
+from ml.alignment import ActionTimeline, relative_mouse_positions
+
+
+# ActionTimeline and data_generator against the sequential merge of the
+# action and frame streams which data_generator did before ActionTimeline.
+
+def merged_positions(action_times, frame_times):
+    # position of the action used for each frame by the old two iterator merge
+    actions_gen = iter(range(1, len(action_times)))
+    action_next = 0
+    action_current = action_next
+    positions = []
+    for frame_time in frame_times:
+        if action_times[action_next] < frame_time:
+            for action in actions_gen:
+                action_current = action_next
+                action_next = action
+                # stop iterating if next action wont be earlier than screenshot time
+                if not (action_times[action_next] < frame_time):
+                    break
+        positions.append(action_current)
+    return positions
+
+
+def make_actions(times):
+    return [{"time_ns": int(t), "mouse_position": [10 * i, 20 * i],
+             "keys": ["a"] if i % 3 == 0 else [],
+             "mouse_buttons": ["mouse left"] if i % 2 else []}
+            for i, t in enumerate(times)]
+
+
+def aligned_positions(action_times, frame_times, block_len=None):
+    # positions of ActionTimeline.align, block by block as in data_generator
+    timeline = ActionTimeline(make_actions(action_times))
+    frame_times = np.asarray(frame_times, dtype=np.int64)
+    if block_len is None:
+        block_len = max(len(frame_times), 1)
+
+    positions = []
+    start = 0
+    for i in range(0, len(frame_times), block_len):
+        aligned = timeline.align(frame_times[i:i + block_len], start=start)
+        start = aligned["action_position"][-1]
+        positions.extend(aligned["action_position"].tolist())
+    return positions
+
+
+cases = {
+    "frames before the first action": ([100, 200, 300], [10, 20, 150, 250]),
+    "frames after the last action": ([100, 200, 300], [150, 250, 350, 400, 500]),
+    "equal timestamps": ([100, 200, 200, 300], [100, 200, 200, 300, 301]),
+    "single action": ([100], [50, 100, 150]),
+    "two actions": ([100, 200], [50, 150, 250]),
+    "frames between actions": ([100, 110, 120, 130, 140], [105, 105, 125, 126, 139]),
+    "timestamps going backwards": ([100, 200, 300, 400], [250, 150, 350, 120, 450]),
+}
+
+
+@pytest.mark.parametrize("action_times, frame_times", cases.values(), ids=list(cases))
+def test_action_positions(action_times, frame_times):
+    assert aligned_positions(action_times, frame_times) == \
+        merged_positions(action_times, frame_times)
+
+
+@pytest.mark.parametrize("block_len", [1, 2, 3, 7])
+@pytest.mark.parametrize("action_times, frame_times", cases.values(), ids=list(cases))
+def test_block_start_carry_over(action_times, frame_times, block_len):
+    assert aligned_positions(action_times, frame_times, block_len) == \
+        merged_positions(action_times, frame_times)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_random_sessions(seed):
+    rng = np.random.default_rng(seed)
+    action_times = np.sort(rng.integers(0, 1000, rng.integers(1, 40)))
+    frame_times = np.sort(rng.integers(-100, 1100, rng.integers(1, 80)))
+    if seed % 4 == 0:
+        # clock adjustments during a recording
+        frame_times = rng.permutation(frame_times)
+    expected = merged_positions(action_times, frame_times)
+    assert aligned_positions(action_times, frame_times) == expected
+    assert aligned_positions(action_times, frame_times, block_len=5) == expected
+
+
+def test_align_fields():
+    action_times = [100, 200, 300, 400]
+    frame_times = [50, 150, 250, 450]
+    actions = make_actions(action_times)
+    aligned = ActionTimeline(actions).align(np.array(frame_times))
+
+    for i, position in enumerate(merged_positions(action_times, frame_times)):
+        action = actions[position]
+        assert aligned["mouse_position"][i].tolist() == action["mouse_position"]
+        assert aligned["left_btn_pressed"][i] == ("mouse left" in action["mouse_buttons"])
+
+
+# data_generator on a json lines session, against the old generator
+
+def datetime_str(time_ns):
+    return str(datetime.datetime.fromtimestamp(time_ns / 1e9))
+
+
+def get_datetime(s):
+    return datetime.datetime.strptime(s, "%Y-%m-%d %H:%M:%S.%f")
+
+
+def merged_data_generator(screens, actions, window_data):
+    # the old data_generator loop, records compared by their "datetime"
+    actions_gen = iter(actions[1:])
+    action_next = actions[0]
+    action_current = action_next
+    for screen_data in screens:
+        if get_datetime(action_next["datetime"]) < get_datetime(screen_data["datetime"]):
+            for action in actions_gen:
+                action_current = action_next
+                action_next = action
+                if not (get_datetime(action_next["datetime"]) <
+                        get_datetime(screen_data["datetime"])):
+                    break
+
+        recorded_size = screen_data["frame"].shape[1::-1]
+        relative_mouse_position = relative_mouse_positions(action_current["mouse_position"],
+                                                           window_data, recorded_size)[0]
+        left_btn_pressed = "mouse left" in action_current["mouse_buttons"]
+        screen_data["relative_mouse_position"] = relative_mouse_position
+        screen_data["left_btn_pressed"] = left_btn_pressed
+
+        mouse_mask = np.zeros((*screen_data["frame"].shape[:2], 2), dtype=np.uint8)
+        mouse_mask[relative_mouse_position[0], relative_mouse_position[1], left_btn_pressed] = 255
+        screen_data["frame"] = np.concatenate([screen_data["frame"], mouse_mask], axis=2)
+        yield screen_data
+
+
+class AllFramesInGame:
+    def is_game_crops(self, crops):
+        return [True] * len(crops)
+
+
+def write_session(directory, postfix, action_times, frame_times):
+    window_data = {"offset": [100, 50], "size": [640, 480]}
+    with open(os.path.join(directory, "window_parameters_{}.txt".format(postfix)), "w") as f:
+        json.dump(window_data, f)
+
+    rng = np.random.default_rng(len(frame_times))
+    actions = []
+    for i, t in enumerate(action_times):
+        actions.append({"mouse_position": [100 + 37 * i % 640, 50 + 23 * i % 480],
+                        "keys": [], "mouse_buttons": ["mouse left"] if i % 2 else [],
+                        "datetime": datetime_str(t)})
+    with open(os.path.join(directory, "actions_{}.txt".format(postfix)), "w") as f:
+        for action in actions:
+            f.write(json.dumps(action) + "\n")
+
+    screens = []
+    for i, t in enumerate(frame_times):
+        screens.append({"frame": rng.integers(0, 255, (24, 32, 3), dtype=np.uint8),
+                        "index": i, "datetime": datetime_str(t)})
+    with open(os.path.join(directory, "screen_{}.txt".format(postfix)), "w") as f:
+        for screen in screens:
+            f.write(json.dumps(screen, cls=nj.NumpyEncoder) + "\n")
+    return screens, actions, window_data
+
+
+# off whole seconds, which str(datetime) writes without microseconds
+start_ns = 1600000000 * 10 ** 9 + 123456 * 1000
+ms = 10 ** 6
+
+sessions = {
+    "frames before and after the actions": (
+        [start_ns + 100 * ms * i for i in range(1, 6)],
+        [start_ns + 30 * ms * i for i in range(25)]),
+    "equal timestamps": (
+        [start_ns + 100 * ms * i for i in (1, 2, 2, 3)],
+        [start_ns + 100 * ms * i for i in (1, 1, 2, 3, 3, 4)]),
+    "single action": (
+        [start_ns + 100 * ms],
+        [start_ns + 50 * ms * i for i in range(5)]),
+}
+
+
+@pytest.mark.parametrize("block_len", [2, 256])
+@pytest.mark.parametrize("action_times, frame_times", sessions.values(), ids=list(sessions))
+def test_data_generator(tmp_path, monkeypatch, action_times, frame_times, block_len):
+    monkeypatch.setattr(dp, "data_dir", str(tmp_path))
+    monkeypatch.setattr(dp, "get_game_classifier", AllFramesInGame)
+    screens, actions, window_data = write_session(str(tmp_path), "test", action_times, frame_times)
+
+    expected = list(merged_data_generator(screens, actions, window_data))
+    records = list(dp.data_generator("test", block_len=block_len))
+    assert len(records) == len(expected)
+    for record, expected_record in zip(records, expected):
+        assert record.keys() == expected_record.keys()
+        for key in record:
+            assert np.array_equal(record[key], expected_record[key]), key
@@ -0,0 +1,149 @@
+import io
+import os
+import numpy as np
+import pytest
+
+import frame_writer as fw
+from recording import frame_file as ff
+from ml.frame_index import FrameIndex
+
+
+# Compressed frames files give back exactly the written frames, sequentially
+# and with random access.
+
+compressions = [None, "zlib", "lzma"]
+keyframe_intervals = [1, 3, 40]
+
+
+def make_frames(n=30, shape=(24, 32, 3), seed=0):
+    # static background with a moving block and a few scene changes
+    rng = np.random.default_rng(seed)
+    background = rng.integers(0, 255, shape, dtype=np.uint8)
+    frames = []
+    for i in range(n):
+        frame = background.copy()
+        frame[i % 16:i % 16 + 8, (2 * i) % 24:(2 * i) % 24 + 8] = 17 * i % 255
+        if i % 11 == 10:
+            background = rng.integers(0, 255, shape, dtype=np.uint8)
+        frames.append(frame)
+    return frames
+
+
+def repeats(n, every=4):
+    # records which repeat the last frame, as marked by FrameDeduplicator
+    return {i for i in range(n) if i % every == every - 1}
+
+
+def write_frames(filename, frames, compression, keyframe_interval, repeated=()):
+    # returns the frame of every record, repeat records have the last written frame
+    expected = []
+    with fw.FrameWriter(filename, compression=compression,
+                        keyframe_interval=keyframe_interval) as writer:
+        for i, frame in enumerate(frames):
+            if i in repeated:
+                writer.add_to_write({"repeat_of": None, "time_ns": i, "monotonic_ns": i})
+                expected.append(expected[-1])
+            else:
+                writer.add_to_write({"frame": frame, "time_ns": i, "monotonic_ns": i})
+                expected.append(frame)
+    return expected
+
+
+@pytest.mark.parametrize("keyframe_interval", keyframe_intervals)
+@pytest.mark.parametrize("compression", ["zlib", "lzma"])
+def test_encoder_round_trip(compression, keyframe_interval):
+    frames = make_frames()
+    encoder = ff.FrameEncoder(compression, keyframe_interval=keyframe_interval)
+    code = ff.compressions[compression]
+
+    previous = None
+    for i, frame in enumerate(frames):
+        record = encoder.pack_record(i, i, i, frame)
+        index, _, _, kind, length = ff.record_struct.unpack_from(record)
+        assert index == i
+        assert kind == (ff.KIND_KEY if i % keyframe_interval == 0 else ff.KIND_DELTA)
+        payload = record[ff.record_struct.size:]
+        assert len(payload) == length
+
+        previous = ff.decode_frame(kind, payload, frame.dtype, frame.shape, code, previous)
+        assert previous.dtype == frame.dtype
+        assert np.array_equal(previous, frame)
+
+
+@pytest.mark.parametrize("compression", compressions)
+def test_header_round_trip(compression):
+    header = ff.pack_header(np.uint8, (24, 32, 3), ff.compressions[compression])
+    assert ff.read_header(io.BytesIO(header)) == \
+        (np.dtype(np.uint8), (24, 32, 3), ff.compressions[compression])
+
+
+@pytest.mark.parametrize("keyframe_interval", keyframe_intervals)
+@pytest.mark.parametrize("compression", compressions)
+def test_frame_generator(tmp_path, compression, keyframe_interval):
+    filename = str(tmp_path / ("screen" + ff.extension))
+    frames = make_frames()
+    expected = write_frames(filename, frames, compression, keyframe_interval,
+                            repeats(len(frames)))
+
+    records = list(ff.frame_generator(filename))
+    assert [record["index"] for record in records] == list(range(len(frames)))
+    assert [record["time_ns"] for record in records] == list(range(len(frames)))
+    for record, frame in zip(records, expected):
+        assert np.array_equal(record["frame"], frame)
+
+
+@pytest.mark.parametrize("keyframe_interval", keyframe_intervals)
+@pytest.mark.parametrize("compression", compressions)
+def test_frame_index_random_access(tmp_path, compression, keyframe_interval):
+    filename = str(tmp_path / ("screen" + ff.extension))
+    frames = make_frames()
+    expected = write_frames(filename, frames, compression, keyframe_interval,
+                            repeats(len(frames)))
+
+    rng = np.random.default_rng(1)
+    with FrameIndex(filename) as index:
+        assert len(index) == len(frames)
+        # random order jumps back to key frames and forward from decoded frames
+        for position in list(rng.permutation(len(frames))) + list(range(len(frames))):
+            assert np.array_equal(index[position]["frame"], expected[position]), position
+        assert np.array_equal(index[-1]["frame"], expected[-1])
+        assert index.nearest(7)["index"] == 7
+
+
+@pytest.mark.parametrize("cut", [1, ff.record_struct.size + 1, "header"])
+@pytest.mark.parametrize("compression", compressions)
+def test_truncated_last_record(tmp_path, compression, cut):
+    # a recording interrupted while writing its last record
+    filename = str(tmp_path / ("screen" + ff.extension))
+    frames = make_frames(n=12)
+    expected = write_frames(filename, frames, compression, keyframe_interval=5,
+                            repeated={3, 7})
+
+    size = os.path.getsize(filename)
+    with open(filename, "rb") as f:
+        last_record_offset = size - _last_record_length(f)
+    if cut == "header":
+        cut = size - last_record_offset - ff.record_struct.size // 2
+    os.truncate(filename, size - cut)
+
+    records = list(ff.frame_generator(filename))
+    assert len(records) == len(frames) - 1
+    for record, frame in zip(records, expected):
+        assert np.array_equal(record["frame"], frame)
+
+    with FrameIndex(filename) as index:
+        assert len(index) == len(frames) - 1
+        for position in reversed(range(len(index))):
+            assert np.array_equal(index[position]["frame"], expected[position])
+
+
+def _last_record_length(f):
+    ff.read_header(f)
+    length = 0
+    while True:
+        record_header = f.read(ff.record_struct.size)
+        if not record_header:
+            return length
+        payload_len = ff.record_struct.unpack(record_header)[4]
+        f.seek(payload_len, os.SEEK_CUR)
+        length = ff.record_struct.size + payload_len
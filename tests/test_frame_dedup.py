@@ -0,0 +1,111 @@
+import threading
+import time
+import numpy as np
+import pytest
+
+import frame_dedup as fd
+import frame_writer as fw
+import json_writer as jw
+from recording import frame_file as ff
+from ml.frame_index import FrameIndex
+
+
+# Repeat records always repeat the frame before them, also when the writer
+# discards frames with overflow = "drop".
+
+class GatedFrameWriter(fw.FrameWriter):
+    # holds the first batch until gate is set, so that records pile up in the queue
+
+    def __init__(self, filename, **kwargs):
+        self.gate = threading.Event()
+        self.started = threading.Event()
+        super().__init__(filename, **kwargs)
+        # room for the frame being written, a queued frame and a repeat record,
+        # not for another frame
+        self.memory_budget = 3 * jw.JsonWriter._record_size({}) + 2 * frame(0).nbytes
+        self.overflow = "drop"
+
+    def _serialize_batch(self, data):
+        self.started.set()
+        self.gate.wait()
+        return super()._serialize_batch(data)
+
+    def drain(self, timeout=5.0):
+        self.gate.set()
+        deadline = time.monotonic() + timeout
+        while self._queued_bytes and time.monotonic() < deadline:
+            time.sleep(0.001)
+
+    def close(self):
+        # a failed test must not leave the writer thread waiting
+        self.gate.set()
+        super().close()
+
+
+def frame(value):
+    return np.full((8, 12, 3), value, dtype=np.uint8)
+
+
+def add(writer, i, data):
+    data.update(time_ns=i, monotonic_ns=i)
+    return writer.add_to_write(data)
+
+
+def written_frames(filename):
+    return [record["frame"][0, 0, 0] for record in ff.frame_generator(filename)]
+
+
+@pytest.mark.parametrize("compression", [None, "zlib"])
+def test_repeat_of_dropped_frame_is_dropped(tmp_path, compression):
+    filename = str(tmp_path / ("screen" + ff.extension))
+    with GatedFrameWriter(filename, compression=compression) as writer:
+        assert add(writer, 0, {"frame": frame(1)})
+        writer.started.wait()
+        assert add(writer, 1, {"frame": frame(2)})
+        assert not add(writer, 2, {"frame": frame(3)})
+        # would repeat frame 2 instead of the discarded frame 3
+        assert not add(writer, 3, {"repeat_of": None})
+        writer.drain()
+        assert add(writer, 4, {"frame": frame(4)})
+        assert add(writer, 5, {"repeat_of": None})
+    assert writer.dropped == 2
+
+    assert written_frames(filename) == [1, 2, 4, 4]
+    with FrameIndex(filename) as index:
+        assert [index[n]["frame"][0, 0, 0] for n in range(len(index))] == [1, 2, 4, 4]
+
+
+def test_repeat_before_any_frame_is_dropped(tmp_path):
+    filename = str(tmp_path / "screen.txt")
+    with jw.JsonWriter(filename) as writer:
+        assert not add(writer, 0, {"repeat_of": None})
+        assert add(writer, 1, {"frame": [1]})
+        assert add(writer, 2, {"repeat_of": None})
+    with open(filename) as f:
+        assert f.read().count("repeat_of") == 1
+
+
+def test_deduplicator_forgets_dropped_frames(tmp_path):
+    # the recorder loop: frames the writer discards are not repeated later
+    filename = str(tmp_path / ("screen" + ff.extension))
+    deduplicator = fd.FrameDeduplicator()
+
+    def record(writer, i, value):
+        data = {"frame": frame(value)}
+        if deduplicator(data) and not add(writer, i, data):
+            deduplicator.forget()
+        elif "repeat_of" in data:
+            add(writer, i, data)
+
+    with GatedFrameWriter(filename, compression="zlib") as writer:
+        record(writer, 0, 1)
+        writer.started.wait()
+        record(writer, 1, 2)
+        record(writer, 2, 3)  # discarded
+        record(writer, 3, 3)  # discarded
+        writer.drain()
+        record(writer, 4, 3)
+        record(writer, 5, 3)
+
+    assert written_frames(filename) == [1, 2, 3, 3]
+    assert deduplicator.repeated == 1